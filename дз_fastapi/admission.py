@@ -0,0 +1,231 @@
+from collections import OrderedDict, defaultdict, deque
+from typing import Dict, Optional
+import asyncio
+import math
+import os
+import time
+
+from dotenv import load_dotenv
+from fastapi import HTTPException, Request, status
+from jose import JWTError, jwt
+
+from auth import SECRET_KEY, ALGORITHM
+
+load_dotenv()
+
+# Глобальный выключатель, например для нагрузочных тестов
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "true").lower() in ("1", "true", "yes")
+# Сколько корзин клиентов держать в памяти, самые давно не использованные вытесняются
+MAX_TRACKED_CLIENTS = int(os.getenv("ADMISSION_MAX_CLIENTS", "100000"))
+
+
+def _env_float(name: str, field: str, default: float) -> float:
+    return float(os.getenv(f"ADMISSION_{name.upper()}_{field}", default))
+
+
+class TokenBucket:
+    """
+    Корзина токенов: пополняется со скоростью rate в секунду, вмещает не больше burst
+    """
+
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, burst: float, now: float):
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, rate: float, burst: float, now: float) -> float:
+        """
+        Забирает токен и возвращает 0 либо сколько секунд ждать следующего
+        """
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / rate
+
+
+class ConcurrencyLimiter:
+    """
+    Не больше limit одновременных запросов, остальные ждут в очереди длиной queue_size
+    Освободившийся слот передаётся первому в очереди
+    """
+
+    def __init__(self, limit: int, queue_size: int, timeout: float):
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.active = 0
+        self._waiters = deque()
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    def try_acquire(self) -> bool:
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            return True
+        return False
+
+    def can_queue(self) -> bool:
+        return len(self._waiters) < self.queue_size
+
+    async def wait(self) -> bool:
+        """
+        Ждёт слот не дольше timeout, возвращает False, если не дождался
+        """
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait({waiter}, timeout=self.timeout)
+        except BaseException:
+            # Запрос отменили, но слот мог успеть перейти к нему
+            if waiter.done():
+                self.release()
+            else:
+                self._abandon(waiter)
+            raise
+        if waiter.done():
+            return True
+        self._abandon(waiter)
+        return False
+
+    def _abandon(self, waiter: asyncio.Future) -> None:
+        waiter.cancel()
+        self._waiters.remove(waiter)
+
+    def release(self) -> None:
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+
+class AdmissionPolicy:
+    """
+    Зависимость FastAPI для роутера или эндпоинта: лимит частоты на клиента и маршрут
+    и, для дорогих маршрутов, лимит одновременных запросов с ограниченной очередью
+    Настройки переопределяются переменными ADMISSION_<NAME>_RATE, _BURST, _CONCURRENCY, _QUEUE, _QUEUE_TIMEOUT
+    """
+
+    def __init__(self, name: str, rate: float, burst: float, concurrency: int = 0,
+                 queue_size: int = 0, queue_timeout: float = 5.0):
+        self.name = name
+        self.rate = _env_float(name, "RATE", rate)
+        self.burst = _env_float(name, "BURST", burst)
+        concurrency = int(_env_float(name, "CONCURRENCY", concurrency))
+        self.limiter = ConcurrencyLimiter(
+            concurrency,
+            int(_env_float(name, "QUEUE", queue_size)),
+            _env_float(name, "QUEUE_TIMEOUT", queue_timeout),
+        ) if concurrency > 0 else None
+        self._buckets: "OrderedDict[tuple, TokenBucket]" = OrderedDict()
+        self.counters: Dict[str, int] = defaultdict(int)
+        self.queue_wait_seconds = 0.0
+
+    async def __call__(self, request: Request):
+        if not ADMISSION_ENABLED:
+            yield
+            return
+
+        retry_after = self._check_rate(request)
+        if retry_after:
+            self.counters["rejected_rate"] += 1
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="Too many requests",
+                headers={"Retry-After": str(math.ceil(retry_after))},
+            )
+
+        if self.limiter is None:
+            self.counters["admitted"] += 1
+            yield
+            return
+
+        await self._acquire()
+        self.counters["admitted"] += 1
+        try:
+            yield
+        finally:
+            self.limiter.release()
+
+    def metrics(self) -> dict:
+        return {
+            "name": self.name,
+            "admitted": self.counters["admitted"],
+            "rejected_rate": self.counters["rejected_rate"],
+            "rejected_queue_full": self.counters["rejected_queue_full"],
+            "rejected_queue_timeout": self.counters["rejected_queue_timeout"],
+            "queued": self.counters["queued"],
+            "queue_wait_seconds": round(self.queue_wait_seconds, 3),
+            "active": self.limiter.active if self.limiter else 0,
+            "waiting": self.limiter.waiting if self.limiter else 0,
+        }
+
+    def _check_rate(self, request: Request) -> float:
+        if self.rate <= 0:
+            return 0.0
+        route = request.scope.get("route")
+        key = (client_key(request), request.method, route.path if route else request.url.path)
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.burst, now)
+            if len(self._buckets) > MAX_TRACKED_CLIENTS:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket.take(self.rate, self.burst, now)
+
+    async def _acquire(self) -> None:
+        limiter = self.limiter
+        if limiter.try_acquire():
+            return
+        if not limiter.can_queue():
+            self.counters["rejected_queue_full"] += 1
+            self._overloaded()
+
+        self.counters["queued"] += 1
+        started = time.monotonic()
+        admitted = await limiter.wait()
+        self.queue_wait_seconds += time.monotonic() - started
+        if not admitted:
+            self.counters["rejected_queue_timeout"] += 1
+            self._overloaded()
+
+    def _overloaded(self):
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Server is busy, try again later",
+            headers={"Retry-After": str(max(1, math.ceil(self.limiter.timeout)))},
+        )
+
+
+def client_key(request: Request) -> str:
+    """
+    Пользователь из действительного токена, иначе IP-адрес клиента
+    """
+    authorization = request.headers.get("authorization", "")
+    if authorization[:7].lower() == "bearer ":
+        try:
+            username: Optional[str] = jwt.decode(authorization[7:], SECRET_KEY,
+                                                 algorithms=[ALGORITHM]).get("sub")
+            if username:
+                return f"user:{username}"
+        except JWTError:
+            pass
+    return f"ip:{request.client.host if request.client else 'unknown'}"
+
+
+# bcrypt в /token, /register и POST /users/ занимает поток на сотни миллисекунд,
+# поэтому у этих маршрутов общий лимит одновременных запросов
+password_admission = AdmissionPolicy("password", rate=1, burst=5, concurrency=4, queue_size=16)
+recommendations_admission = AdmissionPolicy("recommendations", rate=2, burst=10,
+                                            concurrency=8, queue_size=32)
+default_admission = AdmissionPolicy("default", rate=50, burst=100)
+
+policies = [password_admission, recommendations_admission, default_admission]
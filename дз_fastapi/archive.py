@@ -0,0 +1,123 @@
+from datetime import datetime, timedelta
+from typing import Optional
+import asyncio
+import logging
+import os
+
+from dotenv import load_dotenv
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import and_, delete, func, insert, select, text, union_all
+from sqlalchemy.orm import Session
+
+from database import SessionLocal, engine, IS_POSTGRES
+from models import Loan as LoanModel, LoanHistory as LoanHistoryModel
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Возвращённые займы старше этого срока переносятся в loan_history
+ARCHIVE_AFTER_DAYS = int(os.getenv("LOAN_ARCHIVE_AFTER_DAYS", "90"))
+# Период запуска фоновой архивации, 0 отключает её
+ARCHIVE_INTERVAL_SECONDS = int(os.getenv("LOAN_ARCHIVE_INTERVAL_SECONDS", "3600"))
+ARCHIVE_BATCH_SIZE = int(os.getenv("LOAN_ARCHIVE_BATCH_SIZE", "5000"))
+# Ключ advisory-блокировки PostgreSQL, под которой идёт архивация
+ARCHIVE_LOCK_KEY = 7_100_032
+
+LOAN_FIELDS = ("id", "user_id", "book_id", "loan_date", "due_date", "return_date", "status")
+
+
+def all_loans(*fields: str):
+    """
+    Подзапрос со всеми займами: активные из loans и архивные из loan_history
+    """
+    fields = fields or LOAN_FIELDS
+    return union_all(
+        select(*[getattr(LoanModel, field) for field in fields]),
+        select(*[getattr(LoanHistoryModel, field) for field in fields]),
+    ).subquery("all_loans")
+
+
+def ensure_history_partitions(db: Session, batch) -> None:
+    """
+    Создаёт месячные секции loan_history под даты возврата переносимых займов
+    """
+    months = db.query(func.date_trunc("month", LoanModel.return_date)) \
+        .filter(batch) \
+        .distinct()
+    for (month,) in months:
+        next_month = (month + timedelta(days=32)).replace(day=1)
+        db.execute(text(
+            f"CREATE TABLE IF NOT EXISTS loan_history_{month:%Y_%m} PARTITION OF loan_history "
+            f"FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{next_month:%Y-%m-%d}')"
+        ))
+
+
+def archive_returned_loans(db: Session, older_than: Optional[timedelta] = None,
+                           batch_size: int = ARCHIVE_BATCH_SIZE) -> int:
+    """
+    Переносит возвращённые займы старше older_than из loans в loan_history пачками
+    Каждая пачка копируется и удаляется в одной транзакции
+    """
+    cutoff = datetime.utcnow() - (older_than if older_than is not None else timedelta(days=ARCHIVE_AFTER_DAYS))
+    archived = 0
+    archivable = and_(LoanModel.status == "returned", LoanModel.return_date < cutoff)
+    while True:
+        loan_ids = [loan_id for (loan_id,) in
+                    db.query(LoanModel.id)
+                    .filter(archivable)
+                    .order_by(LoanModel.id)
+                    .limit(batch_size)]
+        if not loan_ids:
+            return archived
+
+        # Пачка задаётся границей id, а не списком: без лимита на число параметров запроса
+        batch = and_(archivable, LoanModel.id <= loan_ids[-1])
+        if IS_POSTGRES:
+            ensure_history_partitions(db, batch)
+        db.execute(
+            insert(LoanHistoryModel).from_select(
+                LOAN_FIELDS,
+                select(*[getattr(LoanModel, field) for field in LOAN_FIELDS]).where(batch)
+            )
+        )
+        db.execute(delete(LoanModel).where(batch))
+        db.commit()
+        archived += len(loan_ids)
+
+
+def archive_once() -> int:
+    if not IS_POSTGRES:
+        db = SessionLocal()
+        try:
+            return archive_returned_loans(db)
+        finally:
+            db.close()
+
+    # Каждый воркер запускает свой архиватор: advisory-блокировка пропускает запуск,
+    # если другой воркер уже архивирует. Блокировка сессионная, поэтому все пачки идут через одно соединение
+    with engine.connect() as connection:
+        if not connection.execute(select(func.pg_try_advisory_lock(ARCHIVE_LOCK_KEY))).scalar():
+            logger.info("Loan archival is already running in another worker")
+            return 0
+        connection.commit()
+        db = SessionLocal(bind=connection)
+        try:
+            return archive_returned_loans(db)
+        finally:
+            db.close()
+            connection.execute(select(func.pg_advisory_unlock(ARCHIVE_LOCK_KEY)))
+            connection.commit()
+
+
+async def run_archiver(interval: int = ARCHIVE_INTERVAL_SECONDS) -> None:
+    """
+    Фоновая задача приложения: периодически архивирует займы, не блокируя цикл событий
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            archived = await run_in_threadpool(archive_once)
+            logger.info("Archived %d returned loans", archived)
+        except Exception:
+            logger.exception("Loan archival failed")
@@ -0,0 +1,108 @@
+from typing import Dict, Iterable, Optional, Set
+from collections import defaultdict
+import asyncio
+import json
+import threading
+
+from sqlalchemy.orm import Session
+
+from models import Book as BookModel
+
+MAX_BOOKS_PER_SUBSCRIPTION = 100
+HEARTBEAT_SECONDS = 15.0
+# Блокировки книг: книга берёт блокировку по остатку от деления id
+LOCK_STRIPES = 64
+
+
+class Subscription:
+    """
+    Подписка одного клиента на набор книг
+    Необработанные изменения хранятся по одному на книгу: новое значение затирает старое,
+    поэтому очередь клиента не растёт больше числа книг в подписке
+    """
+
+    def __init__(self, book_ids: Iterable[int]):
+        self.book_ids = set(book_ids)
+        self._pending: Dict[int, int] = {}
+        self._event = asyncio.Event()
+
+    def push(self, book_id: int, copies_available: int) -> None:
+        self._pending[book_id] = copies_available
+        self._event.set()
+
+    async def next_batch(self, timeout: float) -> Dict[int, int]:
+        """
+        Ждёт изменений не дольше timeout секунд и забирает их все разом
+        """
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return {}
+        self._event.clear()
+        batch, self._pending = self._pending, {}
+        return batch
+
+
+class AvailabilityHub:
+    """
+    Раздаёт изменения copies_available подписчикам внутри процесса
+    Публиковать можно из любого потока, доставка всегда идёт в цикле событий
+    """
+
+    def __init__(self):
+        self._subscribers: Dict[int, Set[Subscription]] = defaultdict(set)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+
+    def subscribe(self, book_ids: Iterable[int]) -> Subscription:
+        self._loop = asyncio.get_running_loop()
+        subscription = Subscription(book_ids)
+        for book_id in subscription.book_ids:
+            self._subscribers[book_id].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        for book_id in subscription.book_ids:
+            subscribers = self._subscribers.get(book_id)
+            if subscribers is None:
+                continue
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self._subscribers[book_id]
+
+    def publish(self, book_id: int, copies_available: int) -> None:
+        # Синхронные эндпоинты работают в пуле потоков, поэтому передаём событие в цикл
+        if self._loop is None or self._loop.is_closed() or book_id not in self._subscribers:
+            return
+        self._loop.call_soon_threadsafe(self._deliver, book_id, copies_available)
+
+    def publish_current(self, db: Session, book_id: int) -> None:
+        """
+        Публикует текущее значение из БД после коммита
+        Значение читается заново под блокировкой книги, поэтому каждая следующая публикация
+        не старее предыдущей, даже если параллельные транзакции завершились в обратном порядке
+        """
+        if book_id not in self._subscribers:
+            return
+        with self._locks[book_id % LOCK_STRIPES]:
+            copies_available = db.query(BookModel.copies_available) \
+                .filter(BookModel.id == book_id) \
+                .scalar()
+            # Удалённая книга больше недоступна
+            self.publish(book_id, copies_available or 0)
+
+    def _deliver(self, book_id: int, copies_available: int) -> None:
+        for subscription in self._subscribers.get(book_id, ()):
+            subscription.push(book_id, copies_available)
+
+
+def format_event(changes: Dict[int, int]) -> str:
+    data = json.dumps([
+        {"book_id": book_id, "copies_available": copies_available}
+        for book_id, copies_available in changes.items()
+    ])
+    return f"event: availability\ndata: {data}\n\n"
+
+
+availability_hub = AvailabilityHub()
+
@@ -0,0 +1,115 @@
+"""
+Время расчёта аналитики займов на колонках NumPy и загрузки снимка из БД
+
+Запуск из каталога проекта (размеры для загрузки из SQLite можно переопределить):
+    BENCH_LOAD_SIZES=100000,1000000 python -m benchmarks.bench_analytics
+"""
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+import os
+import tempfile
+import time
+
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+
+import numpy as np
+from sqlalchemy import create_engine, insert
+from sqlalchemy.orm import sessionmaker
+
+from database import Base, engine_options
+from models import Book as BookModel, Loan as LoanModel
+from loan_stats import LoanColumns, LoanColumnsCache
+
+LOAN_COUNTS = (100_000, 1_000_000, 5_000_000)
+LOAD_SIZES = [int(size) for size in os.getenv("BENCH_LOAD_SIZES", "100000,1000000").split(",")]
+N_BOOKS = 50_000
+CHUNK = 100_000
+N_AUTHORS = 10_000
+N_CATEGORIES = 50
+
+
+def make_columns(n_loans: int, rng: np.random.Generator) -> LoanColumns:
+    start = np.datetime64("2015-01-01T00:00:00")
+    loan_date = start + rng.integers(0, 10 * 365 * 86400, n_loans).astype("timedelta64[s]")
+    due_date = loan_date + np.timedelta64(14, "D")
+    return_date = loan_date + rng.integers(1, 30 * 86400, n_loans).astype("timedelta64[s]")
+    return_date[rng.random(n_loans) < 0.1] = np.datetime64("NaT")
+
+    return LoanColumns(
+        authors=np.array([f"Author {i}" for i in range(N_AUTHORS)], dtype=object),
+        categories=np.array([f"Category {i}" for i in range(N_CATEGORIES)], dtype=object),
+        loan_author=rng.integers(0, N_AUTHORS, n_loans),
+        loan_category=rng.integers(0, N_CATEGORIES, n_loans),
+        loan_date=loan_date,
+        due_date=due_date,
+        return_date=return_date,
+    )
+
+
+def timed(func) -> float:
+    started = time.perf_counter()
+    func()
+    return (time.perf_counter() - started) * 1000
+
+
+def fill(engine, n_loans: int):
+    start = datetime(2015, 1, 1)
+    with engine.begin() as connection:
+        connection.execute(insert(BookModel), [
+            {"title": f"Book {i}", "author": f"Author {i % N_AUTHORS}", "isbn": f"isbn-{i}",
+             "published_year": 2000, "category": f"Category {i % N_CATEGORIES}"}
+            for i in range(N_BOOKS)
+        ])
+        for offset in range(0, n_loans, CHUNK):
+            connection.execute(insert(LoanModel), [
+                {"user_id": i % 10_000, "book_id": i % N_BOOKS + 1, "loan_date": start + timedelta(minutes=i),
+                 "due_date": start + timedelta(minutes=i, days=14),
+                 "return_date": start + timedelta(minutes=i, days=5) if i % 10 else None,
+                 "status": "returned" if i % 10 else "active"}
+                for i in range(offset, min(offset + CHUNK, n_loans))
+            ])
+
+
+def bench_load():
+    """
+    Полная загрузка снимка из SQLite и применение одного займа к готовому снимку
+    """
+    print(f"{'loans':>10} {'from_db s':>10} {'add loan us':>12} {'return us':>10}")
+    for n_loans in LOAD_SIZES:
+        with tempfile.TemporaryDirectory() as directory:
+            url = f"sqlite:///{directory}/bench.db"
+            engine = create_engine(url, **engine_options(url))
+            Base.metadata.create_all(bind=engine)
+            fill(engine, n_loans)
+            session_factory = sessionmaker(bind=engine)
+            db = session_factory()
+
+            cache = LoanColumnsCache(session_factory)
+            load = timed(lambda: cache.get(db)) / 1000
+
+            now = datetime.utcnow()
+            loans = [SimpleNamespace(id=n_loans + i + 1, book_id=i % N_BOOKS + 1, loan_date=now,
+                                     due_date=now + timedelta(days=14), return_date=now)
+                     for i in range(1000)]
+            add = timed(lambda: [cache.add_loan(loan) for loan in loans])
+            returned = timed(lambda: [cache.return_loan(loan) for loan in loans])
+            print(f"{n_loans:>10,} {load:>10.2f} {add:>12.1f} {returned:>10.1f}")
+            db.close()
+            engine.dispose()
+
+
+def main():
+    rng = np.random.default_rng(0)
+    print(f"{'loans':>10} {'per category/month ms':>22} {'duration ms':>12} {'overdue ms':>11}")
+    for n_loans in LOAN_COUNTS:
+        columns = make_columns(n_loans, rng)
+        per_month = timed(columns.loans_per_category_month)
+        duration = timed(columns.loan_duration_by_category)
+        overdue = timed(lambda: columns.overdue_rate(by="author"))
+        print(f"{n_loans:>10,} {per_month:>22.1f} {duration:>12.1f} {overdue:>11.1f}")
+    print()
+    bench_load()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Запросы по активным займам при растущей истории: всё в loans против архива в loan_history
+
+Запуск из каталога проекта (размеры истории можно переопределить, например до десятков миллионов):
+    BENCH_HISTORY_SIZES=100000,1000000,10000000 python -m benchmarks.bench_archive
+"""
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+
+from sqlalchemy import create_engine, insert
+from sqlalchemy.orm import sessionmaker
+
+from database import Base, engine_options
+from models import Loan as LoanModel, LoanHistory as LoanHistoryModel
+from archive import archive_returned_loans
+
+HISTORY_SIZES = [int(size) for size in os.getenv("BENCH_HISTORY_SIZES", "100000,1000000").split(",")]
+ACTIVE_LOANS = 10_000
+USERS = 10_000
+CHUNK = 100_000
+REPEATS = 20
+
+
+def fill(engine, returned: int):
+    now = datetime.utcnow()
+    long_ago = now - timedelta(days=365)
+    with engine.begin() as connection:
+        for start in range(0, returned, CHUNK):
+            connection.execute(insert(LoanModel), [
+                {"user_id": i % USERS, "book_id": i % 5000, "loan_date": long_ago,
+                 "due_date": long_ago + timedelta(days=14), "return_date": long_ago + timedelta(days=10),
+                 "status": "returned"}
+                for i in range(start, min(start + CHUNK, returned))
+            ])
+        connection.execute(insert(LoanModel), [
+            {"user_id": i % USERS, "book_id": i % 5000, "loan_date": now,
+             "due_date": now + timedelta(days=(i % 30) - 15), "status": "active"}
+            for i in range(ACTIVE_LOANS)
+        ])
+
+
+def active_queries(db) -> float:
+    now = datetime.utcnow()
+    started = time.perf_counter()
+    for i in range(REPEATS):
+        # get_overdue_loans
+        db.query(LoanModel).filter(LoanModel.status == "active", LoanModel.due_date < now).all()
+        # read_user_loans: горячая таблица и архив
+        db.query(LoanModel).filter(LoanModel.user_id == i).all()
+        db.query(LoanHistoryModel).filter(LoanHistoryModel.user_id == i).all()
+        db.expunge_all()
+    return (time.perf_counter() - started) / REPEATS * 1000
+
+
+def main():
+    print(f"{'history':>12} {'hot table ms':>13} {'archived ms':>12} {'archival s':>11}")
+    for size in HISTORY_SIZES:
+        with tempfile.TemporaryDirectory() as directory:
+            url = f"sqlite:///{directory}/bench.db"
+            engine = create_engine(url, **engine_options(url))
+            Base.metadata.create_all(bind=engine)
+            fill(engine, size)
+            db = sessionmaker(bind=engine)()
+
+            before = active_queries(db)
+            started = time.perf_counter()
+            archive_returned_loans(db, older_than=timedelta(days=30), batch_size=50_000)
+            archival = time.perf_counter() - started
+            after = active_queries(db)
+
+            print(f"{size:>12,} {before:>13.1f} {after:>12.1f} {archival:>11.1f}")
+            db.close()
+            engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
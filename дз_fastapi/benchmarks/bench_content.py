@@ -0,0 +1,70 @@
+"""
+Контентная модель на большом каталоге: время построения, рекомендации, обновления книги и слияние дельты
+
+Запуск из каталога проекта:
+    python -m benchmarks.bench_content
+"""
+import os
+import time
+
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+
+import numpy as np
+
+from content_index import ContentIndex
+
+N_BOOKS = 1_000_000
+N_WORDS = 50_000
+N_AUTHORS = 100_000
+N_CATEGORIES = 200
+HISTORY = 20
+REPEATS = 50
+UPSERTS = 5000
+
+
+def make_catalog(rng: np.random.Generator):
+    words = rng.integers(0, N_WORDS, size=(N_BOOKS, 4))
+    authors = rng.integers(0, N_AUTHORS, N_BOOKS)
+    categories = rng.integers(0, N_CATEGORIES, N_BOOKS)
+    return [
+        (book_id + 1, " ".join(f"w{word}" for word in words[book_id]),
+         f"Author {authors[book_id]}", f"Category {categories[book_id]}")
+        for book_id in range(N_BOOKS)
+    ]
+
+
+def main():
+    rng = np.random.default_rng(0)
+    catalog = make_catalog(rng)
+    index = ContentIndex()
+
+    started = time.perf_counter()
+    index.build_from_rows(catalog)
+    print(f"build {N_BOOKS:,} books: {time.perf_counter() - started:.1f} s")
+
+    histories = [rng.integers(1, N_BOOKS + 1, HISTORY).tolist() for _ in range(REPEATS)]
+    started = time.perf_counter()
+    for history in histories:
+        index.recommend(history, limit=10)
+    print(f"recommend: {(time.perf_counter() - started) / REPEATS * 1000:.1f} ms")
+
+    # Вставок в несколько раз больше DELTA_LIMIT: слияния идут в фоне и в задержку записи не входят
+    latencies = []
+    for book_id in range(1, UPSERTS + 1):
+        started = time.perf_counter()
+        index.upsert(book_id, "updated title", "New Author", "Category 1")
+        latencies.append(time.perf_counter() - started)
+    latencies = np.array(latencies) * 1000
+    print(f"upsert: mean {latencies.mean():.2f} ms, p99 {np.percentile(latencies, 99):.2f} ms, "
+          f"max {latencies.max():.1f} ms")
+
+    index.wait_for_merge()
+    with index._lock:
+        index._merging = True
+    started = time.perf_counter()
+    index._merge()
+    print(f"background merge: {time.perf_counter() - started:.2f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Сравнение сериализации списка книг: ORM + Pydantic против кортежей колонок + orjson
+
+Запуск из каталога проекта:
+    python -m benchmarks.bench_serialization
+"""
+import json
+import os
+import time
+from typing import List
+
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+
+from pydantic import TypeAdapter
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from database import Base
+from models import Book as BookModel
+from schemas import Book
+from fast_json import BOOK_COLUMNS, dump_rows
+
+PAGE_SIZES = (100, 10_000)
+REPEATS = 20
+
+books_adapter = TypeAdapter(List[Book])
+
+
+def make_session(rows: int):
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(bind=engine)
+    db = sessionmaker(bind=engine)()
+    db.bulk_insert_mappings(BookModel, [
+        {
+            "title": f"Book {i}",
+            "author": f"Author {i % 500}",
+            "isbn": f"isbn-{i}",
+            "published_year": 1950 + i % 70,
+            "category": f"Category {i % 20}",
+            "copies_available": 1,
+            "total_copies": 2,
+        }
+        for i in range(rows)
+    ])
+    db.commit()
+    return db
+
+
+def pydantic_path(db, limit: int) -> bytes:
+    # Повторяет то, что делает FastAPI с response_model=List[Book]
+    books = db.query(BookModel).limit(limit).all()
+    validated = books_adapter.validate_python(books, from_attributes=True)
+    return json.dumps(books_adapter.dump_python(validated, mode="json")).encode()
+
+
+def fast_path(db, limit: int) -> bytes:
+    rows = db.query(*BOOK_COLUMNS).limit(limit).all()
+    return dump_rows(BOOK_COLUMNS, rows)
+
+
+def measure(func, db, limit: int) -> float:
+    func(db, limit)
+    db.expunge_all()
+    started = time.perf_counter()
+    for _ in range(REPEATS):
+        func(db, limit)
+        db.expunge_all()
+    elapsed = time.perf_counter() - started
+    return limit * REPEATS / elapsed
+
+
+def main():
+    print(f"{'page size':>10} {'pydantic rows/s':>16} {'fast rows/s':>12} {'speedup':>8}")
+    for limit in PAGE_SIZES:
+        db = make_session(limit)
+        assert json.loads(pydantic_path(db, limit)) == json.loads(fast_path(db, limit))
+        slow = measure(pydantic_path, db, limit)
+        fast = measure(fast_path, db, limit)
+        print(f"{limit:>10} {slow:>16,.0f} {fast:>12,.0f} {fast / slow:>7.1f}x")
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
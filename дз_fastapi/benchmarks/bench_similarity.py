@@ -0,0 +1,74 @@
+"""
+Индекс совместных займов: построение, память, задержка запроса похожих книг и нового займа
+
+Запуск из каталога проекта:
+    python -m benchmarks.bench_similarity
+"""
+import os
+import time
+import tracemalloc
+
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+
+import numpy as np
+
+from similarity import CoOccurrenceIndex
+
+N_USERS = 50_000
+N_BOOKS = 20_000
+N_LOANS = 1_000_000
+REPEATS = 10_000
+NEW_LOANS = 5000
+
+
+def make_pairs(rng: np.random.Generator, count: int) -> np.ndarray:
+    # Популярность книг распределена по Ципфу, как в реальных библиотеках
+    users = rng.integers(0, N_USERS, count)
+    books = (rng.zipf(1.3, count) - 1) % N_BOOKS
+    return np.stack([users, books], axis=1)
+
+
+def main():
+    rng = np.random.default_rng(0)
+    pairs = make_pairs(rng, N_LOANS)
+
+    index = CoOccurrenceIndex()
+    tracemalloc.start()
+    started = time.perf_counter()
+    index.build_from_pairs(pairs.tolist())
+    elapsed = time.perf_counter() - started
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"build {N_LOANS:,} loans, {N_USERS:,} users, {N_BOOKS:,} books: {elapsed:.1f} s, "
+          f"index {retained / 2 ** 20:.0f} MiB, peak {peak / 2 ** 20:.0f} MiB (tracemalloc)")
+
+    book_ids = rng.integers(0, N_BOOKS, REPEATS).tolist()
+    started = time.perf_counter()
+    for book_id in book_ids:
+        index.similar(book_id)
+    print(f"similar: {(time.perf_counter() - started) / REPEATS * 1e6:.0f} us")
+
+    # Новые займы: в задержку входит только обновление топов, где мера выросла;
+    # остальное пересчитывается в фоне и вливается в матрицу пачками
+    latencies = []
+    for user_id, book_id in make_pairs(rng, NEW_LOANS).tolist():
+        started = time.perf_counter()
+        index.add_loan(user_id, book_id)
+        latencies.append(time.perf_counter() - started)
+    started = time.perf_counter()
+    index.wait_for_updates()
+    drained = time.perf_counter() - started
+    latencies = np.array(latencies) * 1e6
+    print(f"add_loan: mean {latencies.mean():.0f} us, p99 {np.percentile(latencies, 99):.0f} us, "
+          f"max {latencies.max():.0f} us; background queue drained {drained:.2f} s after the last loan")
+
+    with index._lock:
+        index._merging, index._pending = index._pending, {}
+        index._merging_users, index._user_extra = index._user_extra, {}
+    started = time.perf_counter()
+    index._merge()
+    print(f"background merge: {time.perf_counter() - started:.2f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Префиксный индекс подсказок на большом каталоге: построение, память и задержка запроса
+
+Запуск из каталога проекта:
+    python -m benchmarks.bench_suggest
+"""
+import os
+import time
+import tracemalloc
+
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+
+import numpy as np
+
+from suggest_index import SuggestIndex
+
+N_BOOKS = 1_000_000
+N_WORDS = 20_000
+N_AUTHORS = 100_000
+QUERIES = ("a", "w1", "w12", "w123", "w1234 w5", "author 4", "author 4242")
+REPEATS = 1000
+UPSERTS = 5000
+
+
+def main():
+    rng = np.random.default_rng(0)
+    words = rng.integers(0, N_WORDS, size=(N_BOOKS, 3))
+    authors = rng.integers(0, N_AUTHORS, N_BOOKS)
+    popularity = rng.zipf(2.0, N_BOOKS)
+    rows = [
+        (book_id, " ".join(f"w{word}" for word in words[book_id]), f"Author {authors[book_id]}",
+         int(popularity[book_id]))
+        for book_id in range(N_BOOKS)
+    ]
+
+    index = SuggestIndex()
+    started = time.perf_counter()
+    index.build_from_rows(rows)
+    print(f"build {N_BOOKS:,} books: {time.perf_counter() - started:.1f} s")
+
+    # Память - всё, что индекс удерживает после сборки, включая списки названий и словарь слотов;
+    # tracemalloc замедляет сборку, поэтому время меряется отдельным проходом выше
+    tracemalloc.start()
+    traced = SuggestIndex()
+    traced.build_from_rows(rows)
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del traced
+    print(f"index memory: {retained / 2 ** 20:.0f} MiB retained, {peak / 2 ** 20:.0f} MiB peak (tracemalloc)")
+
+    for query in QUERIES:
+        started = time.perf_counter()
+        for _ in range(REPEATS):
+            index.suggest(query, limit=10)
+        print(f"{query!r:>14}: {(time.perf_counter() - started) / REPEATS * 1e6:.0f} us")
+
+    # Пачка вставок несколько раз переполняет DELTA_LIMIT: слияния идут в фоне и в задержку записи не входят
+    latencies = []
+    for book_id in range(UPSERTS):
+        started = time.perf_counter()
+        index.upsert(N_BOOKS + book_id, f"new title {book_id}", "New Author")
+        latencies.append(time.perf_counter() - started)
+    latencies = np.array(latencies) * 1e6
+    print(f"upsert: mean {latencies.mean():.0f} us, p99 {np.percentile(latencies, 99):.0f} us, "
+          f"max {latencies.max():.0f} us")
+
+    index.wait_for_merge()
+    with index._lock:
+        index._merging, index._pending = index._pending, []
+    started = time.perf_counter()
+    index._merge()
+    print(f"background merge: {time.perf_counter() - started:.2f} s")
+
+    started = time.perf_counter()
+    for book_id in range(REPEATS):
+        index.add_loan(book_id % 100)
+    print(f"add_loan: {(time.perf_counter() - started) / REPEATS * 1e6:.0f} us")
+
+
+if __name__ == "__main__":
+    main()
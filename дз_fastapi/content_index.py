@@ -0,0 +1,373 @@
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+from collections import Counter
+from itertools import islice
+import logging
+import re
+import threading
+import zlib
+
+import numpy as np
+from scipy import sparse
+from sqlalchemy.orm import Session
+
+from database import SessionLocal, STREAM_BATCH_SIZE
+from models import Book as BookModel
+
+logger = logging.getLogger(__name__)
+
+# Признаки хешируются в блоки фиксированного размера, поэтому словарь не нужно хранить и расширять
+TITLE_FEATURES = 2 ** 18
+AUTHOR_FEATURES = 2 ** 16
+CATEGORY_FEATURES = 2 ** 10
+
+# Новые и изменённые книги копятся в отдельной матрице и сливаются с основной пачками в фоне
+DELTA_LIMIT = 1024
+# После такой доли изменений IDF устаревает и индекс перестраивается из БД
+REBUILD_FRACTION = 0.2
+
+BookRow = Tuple[int, Optional[str], Optional[str], Optional[str]]
+
+
+def tokenize(text: Optional[str]) -> List[str]:
+    return re.findall(r"\w+", (text or "").lower())
+
+
+def feature(value: str, offset: int, size: int) -> int:
+    return offset + zlib.crc32(value.encode()) % size
+
+
+class ContentIndex:
+    """
+    Контентная модель книг: TF-IDF по словам названия и one-hot автора и категории
+    Строки матрицы нормированы, поэтому косинусная близость ко всем книгам
+    считается одним произведением матрицы на вектор профиля пользователя
+    """
+
+    def __init__(self, title_weight: float = 1.0, author_weight: float = 1.0,
+                 category_weight: float = 1.0, session_factory=None):
+        self.weights = (title_weight, author_weight, category_weight)
+        self.n_features = TITLE_FEATURES + AUTHOR_FEATURES + CATEGORY_FEATURES
+        self.built = False
+        # Индекс устарел и перестраивается в фоне, пока запросы обслуживает текущий
+        self.stale = False
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self._session_factory = session_factory or SessionLocal
+        self._rebuilding = False
+        self._thread: Optional[threading.Thread] = None
+        # Изменения книг во время перестроения: применяются к новому индексу перед подменой
+        self._replay: List[Tuple[int, Optional[List[np.ndarray]]]] = []
+        # То же для фонового слияния дельты с основной матрицей
+        self._merging = False
+        self._merge_thread: Optional[threading.Thread] = None
+        self._merge_replay: List[Tuple[int, Optional[List[np.ndarray]]]] = []
+        self._generation = 0
+        self._idf = np.ones(TITLE_FEATURES)
+        self._writes = 0
+        self._reset(sparse.csr_matrix((0, self.n_features)), np.array([], dtype=np.int64))
+
+    def build(self, db: Session) -> None:
+        rows = db.query(BookModel.id, BookModel.title, BookModel.author, BookModel.category) \
+            .yield_per(STREAM_BATCH_SIZE)
+        self.build_from_rows(rows)
+
+    def build_from_rows(self, rows: Iterable[BookRow]) -> None:
+        # Журнал изменений очищается только после подмены: повторное применение записи безвредно
+        with self._lock:
+            self._rebuilding = True
+        try:
+            matrix, book_ids, idf = self._build_matrix(rows)
+            columns, row_of = self._layout(matrix, book_ids)
+        except BaseException:
+            with self._lock:
+                self._rebuilding = False
+                self._replay = []
+            raise
+
+        with self._lock:
+            self._idf = idf
+            self._writes = 0
+            self._generation += 1
+            self._reset(matrix, book_ids, columns, row_of)
+            self._apply(self._replay)
+            self._after_write(len(self._replay))
+            self._replay = []
+            self._rebuilding = False
+            self.stale = False
+            self.built = True
+
+    def ensure_built(self, db: Session) -> None:
+        if not self.built:
+            # Первая сборка идёт в запросе, параллельные запросы ждут её, а не строят свою
+            with self._build_lock:
+                if not self.built:
+                    self.build(db)
+        elif self.stale:
+            with self._lock:
+                start = not self._rebuilding
+                self._rebuilding = True
+            if start:
+                self._thread = threading.Thread(target=self._rebuild_in_background, daemon=True)
+                self._thread.start()
+
+    def wait_for_rebuild(self) -> None:
+        if self._thread is not None:
+            self._thread.join()
+
+    def wait_for_merge(self) -> None:
+        if self._merge_thread is not None:
+            self._merge_thread.join()
+
+    def upsert(self, book_id: int, title: Optional[str], author: Optional[str],
+               category: Optional[str]) -> None:
+        """
+        Добавляет или заменяет вектор книги без перестройки всей матрицы
+        """
+        features = self._features([(book_id, title, author, category)])
+        self._write(book_id, features)
+
+    def remove(self, book_id: int) -> None:
+        self._write(book_id, None)
+
+    def _write(self, book_id: int, features: Optional[List[np.ndarray]]) -> None:
+        with self._lock:
+            if self._rebuilding:
+                self._replay.append((book_id, features))
+            if self._merging:
+                self._merge_replay.append((book_id, features))
+            if self.built:
+                self._apply([(book_id, features)])
+                self._after_write()
+
+    def _build_matrix(self, rows: Iterable[BookRow]) -> Tuple[sparse.csr_matrix, np.ndarray, np.ndarray]:
+        # Строки книг читаются пачками и сразу сворачиваются в числовые признаки
+        chunks, offset = [], 0
+        iterator = iter(rows)
+        while True:
+            batch = list(islice(iterator, STREAM_BATCH_SIZE))
+            if not batch:
+                break
+            features = self._features(batch)
+            features[1] += offset
+            chunks.append(features)
+            offset += len(batch)
+        if chunks:
+            features = [np.concatenate(column) for column in zip(*chunks)]
+        else:
+            features = self._features([])
+        book_ids, doc_index, feature_index = features[:3]
+
+        # Документная частота считается по уникальным словам каждой книги
+        df = np.bincount(feature_index, minlength=TITLE_FEATURES)
+        idf = np.log((1 + len(book_ids)) / (1 + df)) + 1
+
+        return self._encode(features[1:], idf), book_ids, idf
+
+    def recommend(self, read_book_ids: Sequence[int], limit: int = 5) -> List[int]:
+        """
+        Ранжирует непрочитанные книги по косинусной близости к профилю пользователя
+        Профиль - сумма векторов книг из истории займов
+        """
+        with self._lock:
+            n_base = self._base.shape[0]
+            rows = np.array([self._row_of[book_id] for book_id in read_book_ids
+                             if book_id in self._row_of], dtype=np.int64)
+            if len(rows) == 0:
+                return []
+
+            profile = np.asarray(self._base[rows[rows < n_base]].sum(axis=0)).ravel()
+            if self._delta.shape[0]:
+                profile += np.asarray(self._delta[rows[rows >= n_base] - n_base].sum(axis=0)).ravel()
+
+            # В произведении участвуют только ненулевые признаки профиля:
+            # по столбцам CSC это в разы быстрее полного умножения матрицы на вектор
+            columns = np.flatnonzero(profile)
+            weights = profile[columns]
+            parts = [
+                (self._base_columns[:, columns] @ weights, self._base_alive, self._base_ids),
+                (self._delta[:, columns] @ weights, self._delta_alive, self._delta_ids),
+            ]
+            candidate_ids, candidate_scores = [], []
+            for scores, alive, book_ids in parts:
+                found = np.flatnonzero(scores > 0)
+                found = found[alive[found]]
+                candidate_ids.append(book_ids[found])
+                candidate_scores.append(scores[found])
+
+        candidate_ids = np.concatenate(candidate_ids)
+        candidate_scores = np.concatenate(candidate_scores)
+        unread = ~np.isin(candidate_ids, list(read_book_ids))
+        candidate_ids, candidate_scores = candidate_ids[unread], candidate_scores[unread]
+
+        if len(candidate_ids) > limit:
+            best = np.argpartition(-candidate_scores, limit - 1)[:limit]
+            candidate_ids, candidate_scores = candidate_ids[best], candidate_scores[best]
+        order = np.lexsort((candidate_ids, -candidate_scores))
+        return candidate_ids[order].tolist()
+
+    def _features(self, rows: Sequence[BookRow]) -> List[np.ndarray]:
+        """
+        Числовые признаки книг: id, тройки (книга, слово названия, число вхождений), коды автора и категории
+        """
+        doc_index, feature_index, counts = [], [], []
+        for doc, (_, title, _, _) in enumerate(rows):
+            for feature_id, count in Counter(
+                feature(token, 0, TITLE_FEATURES) for token in tokenize(title)
+            ).items():
+                doc_index.append(doc)
+                feature_index.append(feature_id)
+                counts.append(count)
+        return [
+            np.array([row[0] for row in rows], dtype=np.int64),
+            np.array(doc_index, dtype=np.int64),
+            np.array(feature_index, dtype=np.int64),
+            np.array(counts, dtype=np.float64),
+            np.array([
+                feature(author, TITLE_FEATURES, AUTHOR_FEATURES) if author else -1
+                for _, _, author, _ in rows
+            ], dtype=np.int64),
+            np.array([
+                feature(category, TITLE_FEATURES + AUTHOR_FEATURES, CATEGORY_FEATURES) if category else -1
+                for _, _, _, category in rows
+            ], dtype=np.int64),
+        ]
+
+    def _encode(self, features: Sequence[np.ndarray], idf: np.ndarray) -> sparse.csr_matrix:
+        title_weight, author_weight, category_weight = self.weights
+        doc_index, feature_index, counts, author_index, category_index = features
+        n_rows = len(author_index)
+
+        # TF-IDF названия нормируется внутри своего блока, чтобы длина названия не влияла на вес блока
+        values = counts * idf[feature_index]
+        title_norm = np.sqrt(np.bincount(doc_index, weights=values ** 2, minlength=n_rows))
+        values = values / title_norm[doc_index] * title_weight
+
+        has_author, has_category = author_index >= 0, category_index >= 0
+
+        row_index = np.concatenate([doc_index, np.flatnonzero(has_author), np.flatnonzero(has_category)])
+        col_index = np.concatenate([feature_index, author_index[has_author], category_index[has_category]])
+        data = np.concatenate([
+            values,
+            np.full(has_author.sum(), author_weight),
+            np.full(has_category.sum(), category_weight),
+        ])
+
+        row_norm = np.sqrt(np.bincount(row_index, weights=data ** 2, minlength=n_rows))
+        data = data / row_norm[row_index]
+        return sparse.csr_matrix((data, (row_index, col_index)), shape=(n_rows, self.n_features))
+
+    @staticmethod
+    def _layout(matrix: sparse.csr_matrix, book_ids: np.ndarray) -> Tuple[sparse.csc_matrix, Dict[int, int]]:
+        """
+        Столбцовая копия матрицы и номера строк книг: на миллионе книг это сотни миллисекунд,
+        поэтому считается до захвата блокировки
+        """
+        # Словарь собирается пачками: один вызов dict(zip(...)) держит GIL, и запросы стоят всё это время
+        row_of: Dict[int, int] = {}
+        for start in range(0, len(book_ids), STREAM_BATCH_SIZE):
+            end = min(start + STREAM_BATCH_SIZE, len(book_ids))
+            row_of.update(zip(book_ids[start:end].tolist(), range(start, end)))
+        return matrix.tocsc(), row_of
+
+    def _reset(self, matrix: sparse.csr_matrix, book_ids: np.ndarray,
+               columns: Optional[sparse.csc_matrix] = None, row_of: Optional[Dict[int, int]] = None) -> None:
+        if columns is None:
+            columns, row_of = self._layout(matrix, book_ids)
+        self._base = matrix
+        self._base_columns = columns
+        self._base_ids = book_ids
+        self._base_alive = np.ones(len(book_ids), dtype=bool)
+        self._delta = sparse.csr_matrix((0, self.n_features))
+        self._delta_ids = np.array([], dtype=np.int64)
+        self._delta_alive = np.array([], dtype=bool)
+        self._row_of = row_of
+
+    def _drop(self, book_id: int) -> None:
+        row = self._row_of.pop(book_id, None)
+        if row is None:
+            return
+        n_base = self._base.shape[0]
+        if row < n_base:
+            self._base_alive[row] = False
+        else:
+            self._delta_alive[row - n_base] = False
+
+    def _apply(self, writes: List[Tuple[int, Optional[List[np.ndarray]]]]) -> None:
+        """
+        Заменяет векторы книг (или удаляет книгу, если features нет); вызывается под self._lock
+        Пачка кодируется и дописывается в дельту за один vstack, поэтому повтор журнала после
+        слияния или перестроения не копирует дельту на каждую запись
+        """
+        latest: Dict[int, Optional[List[np.ndarray]]] = {}
+        for book_id, features in writes:
+            self._drop(book_id)
+            latest[book_id] = features
+        added = [(book_id, features) for book_id, features in latest.items() if features is not None]
+        if not added:
+            return
+
+        columns = [np.concatenate(column) for column in zip(*(features for _, features in added))]
+        # У каждой записи одна книга, её строка в пачке - номер записи
+        columns[1] = np.repeat(np.arange(len(added)), [len(features[1]) for _, features in added])
+        vectors = self._encode(columns[1:], self._idf)
+        book_ids = columns[0]
+        start = self._base.shape[0] + self._delta.shape[0]
+        self._row_of.update(zip(book_ids.tolist(), range(start, start + len(added))))
+        self._delta = sparse.vstack([self._delta, vectors], format="csr")
+        self._delta_ids = np.concatenate([self._delta_ids, book_ids])
+        self._delta_alive = np.concatenate([self._delta_alive, np.ones(len(added), dtype=bool)])
+
+    def _rebuild_in_background(self) -> None:
+        db = self._session_factory()
+        try:
+            with self._build_lock:
+                self.build(db)
+        except Exception:
+            logger.exception("Content index rebuild failed")
+        finally:
+            db.close()
+
+    def _after_write(self, count: int = 1) -> None:
+        self._writes += count
+        if self._writes > max(DELTA_LIMIT, REBUILD_FRACTION * self._base.shape[0]):
+            # IDF сильно устарел: следующий запрос запустит перестроение из БД в фоне
+            self.stale = True
+        self._start_merge()
+
+    def _start_merge(self) -> None:
+        if self._delta.shape[0] >= DELTA_LIMIT and not self._merging:
+            # Слияние копирует всю матрицу, поэтому идёт в фоне, а запись и рекомендации его не ждут
+            self._merging = True
+            self._merge_thread = threading.Thread(target=self._merge, daemon=True)
+            self._merge_thread.start()
+
+    def _merge(self) -> None:
+        """
+        Вливает дельту в основную матрицу и выкидывает удалённые строки
+        Записи после снимка повторяются на новой матрице, под блокировкой только снимок и подмена
+        """
+        with self._lock:
+            generation = self._generation
+            base, delta = self._base, self._delta
+            alive = np.concatenate([self._base_alive, self._delta_alive])
+            book_ids = np.concatenate([self._base_ids, self._delta_ids])[alive]
+        try:
+            matrix = sparse.vstack([base, delta], format="csr")[alive]
+            columns, row_of = self._layout(matrix, book_ids)
+        except Exception:
+            logger.exception("Content index merge failed")
+            matrix = None
+
+        with self._lock:
+            self._merging = False
+            replay, self._merge_replay = self._merge_replay, []
+            # Если индекс перестроили, пока шло слияние, его результат уже не нужен
+            if matrix is not None and generation == self._generation:
+                # Старый словарь строк освобождается уже после выхода из блокировки
+                row_of, self._row_of = self._row_of, row_of
+                self._reset(matrix, book_ids, columns, self._row_of)
+                self._apply(replay)
+            self._start_merge()
+
+
+content_index = ContentIndex()
@@ -1,4 +1,5 @@
 from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 import os
@@ -8,11 +9,38 @@ load_dotenv()
 
 SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL")
 
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
-)
+# Размер пачки при потоковом чтении больших таблиц (серверный курсор в PostgreSQL)
+STREAM_BATCH_SIZE = int(os.getenv("DB_STREAM_BATCH_SIZE", "10000"))
+
+
+def engine_options(url: str) -> dict:
+    """
+    Параметры движка для выбранной СУБД
+    SQLite работает без пула, для PostgreSQL пул настраивается через переменные окружения
+    """
+    backend = make_url(url).get_backend_name()
+    if backend == "sqlite":
+        return {"connect_args": {"check_same_thread": False}}
+
+    # Каждый воркер держит свой пул: всего соединений workers * (pool_size + max_overflow)
+    options = {
+        "pool_size": int(os.getenv("DB_POOL_SIZE", "5")),
+        "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", "10")),
+        "pool_timeout": int(os.getenv("DB_POOL_TIMEOUT", "30")),
+        "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", "1800")),
+        "pool_pre_ping": os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes"),
+    }
+    statement_timeout = os.getenv("DB_STATEMENT_TIMEOUT_MS")
+    if backend == "postgresql" and statement_timeout:
+        options["connect_args"] = {"options": f"-c statement_timeout={int(statement_timeout)}"}
+    return options
+
+
+engine = create_engine(SQLALCHEMY_DATABASE_URL, **engine_options(SQLALCHEMY_DATABASE_URL))
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+IS_POSTGRES = engine.dialect.name == "postgresql"
+
 Base = declarative_base()
 
 # Зависимость для получения сессии БД
@@ -21,4 +49,4 @@ def get_db():
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
@@ -0,0 +1,57 @@
+from typing import Iterable, Sequence
+import os
+
+import orjson
+from fastapi import Response
+from dotenv import load_dotenv
+
+from models import Book as BookModel, Loan as LoanModel, LoanHistory as LoanHistoryModel, User as UserModel
+
+load_dotenv()
+
+# Быстрый путь для списочных эндпоинтов включается явно через переменную окружения
+FAST_JSON_RESPONSES = os.getenv("FAST_JSON_RESPONSES", "false").lower() in ("1", "true", "yes")
+
+# Колонки перечислены в порядке полей Pydantic-схем, чтобы JSON совпадал байт в байт
+BOOK_COLUMNS = (
+    BookModel.title,
+    BookModel.author,
+    BookModel.isbn,
+    BookModel.published_year,
+    BookModel.category,
+    BookModel.copies_available,
+    BookModel.total_copies,
+    BookModel.id,
+)
+
+LOAN_COLUMNS = (
+    LoanModel.user_id,
+    LoanModel.book_id,
+    LoanModel.due_date,
+    LoanModel.id,
+    LoanModel.loan_date,
+    LoanModel.return_date,
+    LoanModel.status,
+)
+
+LOAN_HISTORY_COLUMNS = tuple(getattr(LoanHistoryModel, column.key) for column in LOAN_COLUMNS)
+
+USER_COLUMNS = (
+    UserModel.email,
+    UserModel.username,
+    UserModel.id,
+    UserModel.is_active,
+    UserModel.is_admin,
+)
+
+
+def dump_rows(columns: Sequence, rows: Iterable[Sequence]) -> bytes:
+    """
+    Сериализует кортежи колонок в JSON без построения ORM-объектов и Pydantic-моделей
+    """
+    keys = [column.key for column in columns]
+    return orjson.dumps([dict(zip(keys, row)) for row in rows])
+
+
+def rows_response(columns: Sequence, rows: Iterable[Sequence]) -> Response:
+    return Response(content=dump_rows(columns, rows), media_type="application/json")
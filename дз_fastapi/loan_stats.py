@@ -0,0 +1,334 @@
+from typing import Dict, List, Optional
+from datetime import datetime
+import logging
+import threading
+
+import numpy as np
+from sqlalchemy import String, cast, select
+from sqlalchemy.orm import Session
+
+from database import SessionLocal, STREAM_BATCH_SIZE
+from models import Book as BookModel
+from archive import all_loans
+
+logger = logging.getLogger(__name__)
+
+
+def _dates(values) -> np.ndarray:
+    """
+    Даты читаются из БД строками: разбор строк в NumPy в десятки раз быстрее преобразования объектов datetime
+    """
+    return np.array(values, dtype="datetime64[us]").astype("datetime64[s]")
+
+
+def _date(value: Optional[datetime]) -> np.datetime64:
+    return np.datetime64(value, "s") if value is not None else np.datetime64("NaT")
+
+
+class LoanColumns:
+    """
+    Снимок займов и книг в виде колонок NumPy
+    Все агрегаты считаются векторно, без обхода ORM-объектов
+    Новые займы дописываются в конец колонок, возвраты правят колонку return_date на месте
+    """
+
+    def __init__(self, authors: np.ndarray, categories: np.ndarray,
+                 loan_author: np.ndarray, loan_category: np.ndarray,
+                 loan_date: np.ndarray, due_date: np.ndarray, return_date: np.ndarray,
+                 loan_ids: Optional[np.ndarray] = None, book_ids: Optional[np.ndarray] = None,
+                 book_author: Optional[np.ndarray] = None, book_category: Optional[np.ndarray] = None):
+        self.authors = authors
+        self.categories = categories
+        self.loan_author = loan_author
+        self.loan_category = loan_category
+        self.loan_date = loan_date
+        self.due_date = due_date
+        self.return_date = return_date
+        self.loan_ids = loan_ids if loan_ids is not None else np.zeros(len(loan_date), dtype=np.int64)
+        # Книги отсортированы по id, коды автора и категории нужны для дописывания займов
+        self.book_ids = book_ids if book_ids is not None else np.zeros(0, dtype=np.int64)
+        self.book_author = book_author if book_author is not None else np.zeros(0, dtype=np.int64)
+        self.book_category = book_category if book_category is not None else np.zeros(0, dtype=np.int64)
+        # Колонки займов - буферы с запасом, действительны первые size элементов
+        self.size = len(loan_date)
+        # Займы, закоммиченные не по порядку id, ищутся по словарю id -> строка,
+        # а в колонку id пишется id предыдущей строки: колонка не убывает и годится для бинарного поиска
+        self._unordered: Dict[int, int] = {}
+        if np.any(self.loan_ids[1:] < self.loan_ids[:-1]):
+            self._unordered = {loan_id: row for row, loan_id in enumerate(self.loan_ids.tolist())}
+
+    @classmethod
+    def from_db(cls, db: Session) -> "LoanColumns":
+        books = db.execute(
+            select(BookModel.id, BookModel.author, BookModel.category).order_by(BookModel.id)
+        ).all()
+        book_ids = np.array([book.id for book in books], dtype=np.int64)
+        authors, author_codes = np.unique(
+            np.array([book.author or "" for book in books], dtype=object), return_inverse=True
+        )
+        categories, category_codes = np.unique(
+            np.array([book.category or "" for book in books], dtype=object), return_inverse=True
+        )
+
+        # Займы читаются пачками и сразу превращаются в колонки: в памяти не бывает больше одной пачки кортежей
+        source = all_loans("id", "book_id", "loan_date", "due_date", "return_date")
+        statement = select(
+            source.c.id, source.c.book_id,
+            cast(source.c.loan_date, String), cast(source.c.due_date, String), cast(source.c.return_date, String),
+        )
+        chunks = []
+        result = db.connection().execution_options(yield_per=STREAM_BATCH_SIZE).execute(statement)
+        for batch in result.partitions():
+            loan_id, loan_book, loan_date, due_date, return_date = zip(*batch)
+            chunks.append((
+                np.array(loan_id, dtype=np.int64),
+                np.array([book_id or 0 for book_id in loan_book], dtype=np.int64),
+                _dates(loan_date), _dates(due_date), _dates(return_date),
+            ))
+        if chunks:
+            loan_id, loan_book, loan_date, due_date, return_date = map(np.concatenate, zip(*chunks))
+        else:
+            loan_id, loan_book = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+            loan_date = due_date = return_date = np.zeros(0, dtype="datetime64[s]")
+
+        # Займы удалённых книг не относятся ни к одной категории и отбрасываются
+        position = np.searchsorted(book_ids, loan_book)
+        position = np.minimum(position, max(len(book_ids) - 1, 0))
+        known = book_ids[position] == loan_book if len(book_ids) else np.zeros(len(loan_book), dtype=bool)
+        # Сортировка по id позволяет находить займ при возврате бинарным поиском
+        order = np.flatnonzero(known)[np.argsort(loan_id[known], kind="stable")]
+        position = position[order]
+
+        return cls(
+            authors=authors,
+            categories=categories,
+            loan_author=author_codes[position],
+            loan_category=category_codes[position],
+            loan_date=loan_date[order],
+            due_date=due_date[order],
+            return_date=return_date[order],
+            loan_ids=loan_id[order],
+            book_ids=book_ids,
+            book_author=author_codes,
+            book_category=category_codes,
+        )
+
+    def add_loan(self, loan_id: int, book_id: int, loan_date: Optional[datetime],
+                 due_date: Optional[datetime], return_date: Optional[datetime] = None) -> bool:
+        """
+        Дописывает займ в конец колонок
+        Возвращает False, если книги нет в снимке и его нужно перестроить
+        """
+        position = int(np.searchsorted(self.book_ids, book_id))
+        if position == len(self.book_ids) or self.book_ids[position] != book_id:
+            return False
+
+        size = self.size
+        if size == len(self.loan_ids):
+            self._grow(max(1024, 2 * size))
+        if size and loan_id <= self.loan_ids[size - 1]:
+            self._unordered[loan_id] = size
+            loan_id = self.loan_ids[size - 1]
+        # Сначала пишутся значения, потом растёт size: читатели видят только заполненные строки
+        self.loan_ids[size] = loan_id
+        self.loan_author[size] = self.book_author[position]
+        self.loan_category[size] = self.book_category[position]
+        self.loan_date[size] = _date(loan_date)
+        self.due_date[size] = _date(due_date)
+        self.return_date[size] = _date(return_date)
+        self.size = size + 1
+        return True
+
+    def return_loan(self, loan_id: int, return_date: Optional[datetime]) -> bool:
+        row = self._find(loan_id)
+        if row is None:
+            return False
+        self.return_date[row] = _date(return_date)
+        return True
+
+    def has_loan(self, loan_id: int) -> bool:
+        return self._find(loan_id) is not None
+
+    def _find(self, loan_id: int) -> Optional[int]:
+        row = self._unordered.get(loan_id)
+        if row is not None:
+            return row
+        # Повторённые id стоят после настоящего, левый бинарный поиск находит настоящую строку
+        loan_ids = self.loan_ids[:self.size]
+        row = int(np.searchsorted(loan_ids, loan_id))
+        return row if row < len(loan_ids) and loan_ids[row] == loan_id else None
+
+    def _grow(self, capacity: int) -> None:
+        for name in ("loan_ids", "loan_author", "loan_category", "loan_date", "due_date", "return_date"):
+            column = getattr(self, name)
+            grown = np.empty(capacity, dtype=column.dtype)
+            grown[:self.size] = column[:self.size]
+            setattr(self, name, grown)
+
+    def _loans(self):
+        """
+        Согласованные срезы колонок займов: size читается один раз
+        """
+        size = self.size
+        return (self.loan_author[:size], self.loan_category[:size], self.loan_date[:size],
+                self.due_date[:size], self.return_date[:size])
+
+    def loans_per_category_month(self) -> List[Dict]:
+        _, loan_category, loan_date, _, _ = self._loans()
+        dated = ~np.isnat(loan_date)
+        if not dated.any():
+            return []
+
+        # Номер месяца считается арифметически, без сортировки дат
+        month_numbers = loan_date[dated].astype("datetime64[M]").astype(np.int64)
+        first_month = month_numbers.min()
+        month_codes = month_numbers - first_month
+        n_months = int(month_codes.max()) + 1
+        months = np.arange(first_month, first_month + n_months).astype("datetime64[M]")
+
+        # Пара (категория, месяц) кодируется одним числом и считается одним bincount
+        keys = loan_category[dated] * n_months + month_codes
+        counts = np.bincount(keys, minlength=len(self.categories) * n_months)
+        found = np.flatnonzero(counts)
+
+        return [
+            {"category": self.categories[key // n_months], "month": str(months[key % n_months]),
+             "loans": int(counts[key])}
+            for key in found
+        ]
+
+    def loan_duration_by_category(self) -> List[Dict]:
+        _, loan_category, loan_date, _, return_date = self._loans()
+        returned = ~np.isnat(return_date) & ~np.isnat(loan_date)
+        days = (return_date[returned] - loan_date[returned]) / np.timedelta64(1, "D")
+        codes = loan_category[returned]
+
+        n_categories = len(self.categories)
+        counts = np.bincount(codes, minlength=n_categories)
+        totals = np.bincount(codes, weights=days, minlength=n_categories)
+        found = np.flatnonzero(counts)
+
+        return [
+            {"category": self.categories[code], "returned_loans": int(counts[code]),
+             "average_days": float(totals[code] / counts[code])}
+            for code in found
+        ]
+
+    def overdue_rate(self, by: str = "author", now: Optional[datetime] = None,
+                     limit: int = 100) -> List[Dict]:
+        loan_author, loan_category, _, due_date, return_date = self._loans()
+        now = np.datetime64(now or datetime.utcnow(), "s")
+        returned = ~np.isnat(return_date)
+
+        # Просрочен, если вернули позже срока или ещё не вернули, а срок прошёл
+        overdue = np.where(returned, return_date > due_date, due_date < now)
+
+        names, codes = (self.authors, loan_author) if by == "author" \
+            else (self.categories, loan_category)
+        counts = np.bincount(codes, minlength=len(names))
+        overdue_counts = np.bincount(codes, weights=overdue, minlength=len(names))
+        found = np.flatnonzero(counts)
+
+        rates = overdue_counts[found] / counts[found]
+        order = found[np.lexsort((found, -rates))][:limit]
+
+        return [
+            {"name": names[code], "loans": int(counts[code]), "overdue": int(overdue_counts[code]),
+             "overdue_rate": float(overdue_counts[code] / counts[code])}
+            for code in order
+        ]
+
+
+class LoanColumnsCache:
+    """
+    Хранит последний снимок: займы и возвраты применяются к нему на месте,
+    а после изменения книг снимок перестраивается в фоне, пока запросы обслуживает старый
+    """
+
+    def __init__(self, session_factory=None):
+        self._session_factory = session_factory or SessionLocal
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self._columns: Optional[LoanColumns] = None
+        self._stale = False
+        self._rebuilding = False
+        self._thread: Optional[threading.Thread] = None
+        # Изменения займов во время перестроения: применяются к новому снимку перед подменой
+        self._replay: List[tuple] = []
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._stale = True
+
+    def add_loan(self, loan) -> None:
+        self._apply(("add", loan.id, loan.book_id, loan.loan_date, loan.due_date, loan.return_date))
+
+    def return_loan(self, loan) -> None:
+        self._apply(("return", loan.id, loan.return_date))
+
+    def get(self, db: Session) -> LoanColumns:
+        if self._columns is None:
+            # Первый снимок строится в запросе, но только один раз на процесс
+            with self._build_lock:
+                if self._columns is None:
+                    self._rebuild(db)
+            return self._columns
+
+        with self._lock:
+            start = self._stale and not self._rebuilding
+            if start:
+                self._rebuilding = True
+        if start:
+            self._thread = threading.Thread(target=self._rebuild_in_background, daemon=True)
+            self._thread.start()
+        return self._columns
+
+    def wait_for_rebuild(self) -> None:
+        if self._thread is not None:
+            self._thread.join()
+
+    def _apply(self, change: tuple) -> None:
+        with self._lock:
+            if self._rebuilding:
+                self._replay.append(change)
+            if self._columns is not None and not self._apply_to(self._columns, change):
+                self._stale = True
+
+    @staticmethod
+    def _apply_to(columns: LoanColumns, change: tuple) -> bool:
+        if change[0] == "add":
+            return columns.has_loan(change[1]) or columns.add_loan(*change[1:])
+        return columns.return_loan(*change[1:])
+
+    def _rebuild_in_background(self) -> None:
+        db = self._session_factory()
+        try:
+            with self._build_lock:
+                self._rebuild(db)
+        except Exception:
+            logger.exception("Loan snapshot rebuild failed")
+        finally:
+            db.close()
+
+    def _rebuild(self, db: Session) -> None:
+        with self._lock:
+            self._rebuilding = True
+            self._stale = False
+            self._replay = []
+        try:
+            columns = LoanColumns.from_db(db)
+        except Exception:
+            with self._lock:
+                self._rebuilding = False
+                self._stale = True
+            raise
+        with self._lock:
+            for change in self._replay:
+                if not self._apply_to(columns, change):
+                    self._stale = True
+            self._columns = columns
+            self._rebuilding = False
+            self._replay = []
+
+
+loan_columns = LoanColumnsCache()
@@ -1,30 +1,48 @@
 from fastapi import FastAPI, Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordRequestForm
 from sqlalchemy.orm import Session
+from contextlib import asynccontextmanager
 from datetime import timedelta
+import asyncio
 
 from database import engine, get_db
 from models import Base
 from auth import authenticate_user, create_access_token, ACCESS_TOKEN_EXPIRE_MINUTES
 from schemas import Token, User, UserCreate
-from routers import users, books, loans, recommendations
+from routers import users, books, loans, analytics, metrics
+import recommendations
 from dependencies import get_password_hash
+from archive import run_archiver, ARCHIVE_INTERVAL_SECONDS
+from admission import default_admission, password_admission
 
 # Создаем таблицы в БД
 Base.metadata.create_all(bind=engine)
 
-app = FastAPI(title="Library Management System", description="API for library management")
 
-# Подключаем роутеры
-app.include_router(users.router)
-app.include_router(books.router)
-app.include_router(loans.router)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Фоновая архивация возвращённых займов
+    archiver = asyncio.create_task(run_archiver()) if ARCHIVE_INTERVAL_SECONDS > 0 else None
+    yield
+    if archiver:
+        archiver.cancel()
+
+
+app = FastAPI(title="Library Management System", description="API for library management",
+              lifespan=lifespan)
+
+# Подключаем роутеры, у дорогих маршрутов собственная политика допуска
+app.include_router(users.router, dependencies=[Depends(default_admission)])
+app.include_router(books.router, dependencies=[Depends(default_admission)])
+app.include_router(loans.router, dependencies=[Depends(default_admission)])
 app.include_router(recommendations.router)
+app.include_router(analytics.router, dependencies=[Depends(default_admission)])
+app.include_router(metrics.router)
 
 
-@app.post("/token", response_model=Token)
-async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(),
-                                 db: Session = Depends(get_db)):
+@app.post("/token", response_model=Token, dependencies=[Depends(password_admission)])
+def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(),
+                           db: Session = Depends(get_db)):
     user = authenticate_user(db, form_data.username, form_data.password)
     if not user:
         raise HTTPException(
@@ -39,7 +57,7 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
     return {"access_token": access_token, "token_type": "bearer"}
 
 
-@app.post("/register", response_model=User)
+@app.post("/register", response_model=User, dependencies=[Depends(password_admission)])
 def register_user(user: UserCreate, db: Session = Depends(get_db)):
     db_user = db.query(users.UserModel).filter(users.UserModel.email == user.email).first()
     if db_user:
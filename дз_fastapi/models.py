@@ -1,5 +1,6 @@
-from sqlalchemy import Column, Integer, String, DateTime, Boolean, ForeignKey, Float
+from sqlalchemy import Column, Integer, String, DateTime, Boolean, ForeignKey, Float, Index, func, text
 from sqlalchemy.orm import relationship
+import sqlalchemy.dialects.postgresql  # noqa: F401 регистрирует типы функций полнотекстового поиска
 from database import Base
 from datetime import datetime
 
@@ -32,8 +33,20 @@ class Book(Base):
     loans = relationship("Loan", back_populates="book")
 
 
+# Полнотекстовый поиск по названию и автору в PostgreSQL, индекс создаётся только там
+# Конфигурация подставляется литералом, иначе выражение запроса не совпадёт с выражением индекса
+SEARCH_CONFIG = text("'simple'")
+book_search_vector = func.to_tsvector(
+    SEARCH_CONFIG, func.coalesce(Book.title, "") + " " + func.coalesce(Book.author, "")
+)
+Index("ix_books_search", book_search_vector, postgresql_using="gin").ddl_if(dialect="postgresql")
+
+
 class Loan(Base):
     __tablename__ = "loans"
+    # Без AUTOINCREMENT SQLite отдаёт освободившийся максимальный id заново,
+    # и после архивации новый займ совпал бы по id с займом из loan_history
+    __table_args__ = {"sqlite_autoincrement": True}
 
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"))
@@ -44,4 +57,22 @@ class Loan(Base):
     status = Column(String, default="active")  # active, returned, overdue
 
     user = relationship("User", back_populates="loans")
-    book = relationship("Book", back_populates="loans")
\ No newline at end of file
+    book = relationship("Book", back_populates="loans")
+
+
+class LoanHistory(Base):
+    """
+    Архив вернувшихся займов, перенесённых из loans
+    В PostgreSQL таблица секционирована по месяцам даты возврата
+    """
+    __tablename__ = "loan_history"
+    __table_args__ = {"postgresql_partition_by": "RANGE (return_date)"}
+
+    # Ключ секционирования обязан входить в первичный ключ
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    return_date = Column(DateTime, primary_key=True)
+    user_id = Column(Integer, index=True)
+    book_id = Column(Integer, index=True)
+    loan_date = Column(DateTime)
+    due_date = Column(DateTime)
+    status = Column(String, default="returned")
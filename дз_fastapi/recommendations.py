@@ -5,11 +5,15 @@ from typing import List, Dict
 from collections import Counter
 
 from database import get_db
-from models import Loan as LoanModel, Book as BookModel, User as UserModel
+from models import Book as BookModel, User as UserModel
 from schemas import RecommendationRequest, RecommendationResponse, Book
 from auth import get_current_user
+from content_index import content_index
+from archive import all_loans
+from admission import recommendations_admission
 
-router = APIRouter(prefix="/recommendations", tags=["recommendations"])
+router = APIRouter(prefix="/recommendations", tags=["recommendations"],
+                   dependencies=[Depends(recommendations_admission)])
 
 
 def collaborative_filtering(db: Session, user_id: int, limit: int = 5) -> List[BookModel]:
@@ -17,8 +21,9 @@ def collaborative_filtering(db: Session, user_id: int, limit: int = 5) -> List[B
     Коллаборативная фильтрация основанная на займах книг
     Находит пользователей с похожими предпочтениями и рекомендует их любимые книги
     """
-    # Получаем историю займов пользователя
-    user_loans = db.query(LoanModel).filter(LoanModel.user_id == user_id).all()
+    # Получаем историю займов пользователя, включая архив
+    loans = all_loans("user_id", "book_id")
+    user_loans = db.query(loans).filter(loans.c.user_id == user_id).all()
     user_books = {loan.book_id for loan in user_loans}
 
     if not user_books:
@@ -30,7 +35,7 @@ def collaborative_filtering(db: Session, user_id: int, limit: int = 5) -> List[B
     all_users = db.query(UserModel).filter(UserModel.id != user_id).all()
 
     for other_user in all_users:
-        other_loans = db.query(LoanModel).filter(LoanModel.user_id == other_user.id).all()
+        other_loans = db.query(loans).filter(loans.c.user_id == other_user.id).all()
         other_books = {loan.book_id for loan in other_loans}
 
         # Вычисляем схожесть (Jaccard similarity)
@@ -47,7 +52,7 @@ def collaborative_filtering(db: Session, user_id: int, limit: int = 5) -> List[B
     # Собираем рекомендации от похожих пользователей
     recommendations = Counter()
     for similar_user_id, similarity in similar_users[:10]:  # Берем топ 10 похожих
-        similar_loans = db.query(LoanModel).filter(LoanModel.user_id == similar_user_id).all()
+        similar_loans = db.query(loans).filter(loans.c.user_id == similar_user_id).all()
         for loan in similar_loans:
             if loan.book_id not in user_books:  # Пропускаем уже прочитанные
                 recommendations[loan.book_id] += similarity
@@ -59,71 +64,35 @@ def collaborative_filtering(db: Session, user_id: int, limit: int = 5) -> List[B
 
 def content_based_filtering(db: Session, user_id: int, limit: int = 5) -> List[BookModel]:
     """
-    Контентная фильтрация на основе категорий и авторов
+    Контентная фильтрация: близость книг по словам названия, автору и категории
+    к профилю, собранному из истории займов пользователя
     """
-    # Анализируем предпочтения пользователя
-    user_loans = db.query(LoanModel).join(BookModel).filter(LoanModel.user_id == user_id).all()
+    loans = all_loans("user_id", "book_id")
+    read_book_ids = [book_id for (book_id,) in
+                     db.query(loans.c.book_id).filter(loans.c.user_id == user_id)]
 
-    if not user_loans:
+    if not read_book_ids:
         return get_popular_books(db, limit)
 
-    # Собираем статистику по категориям и авторам
-    categories = Counter()
-    authors = Counter()
+    content_index.ensure_built(db)
+    # Пустой список, если всё похожее уже прочитано: популярные книги могли бы повторить прочитанные
+    top_book_ids = content_index.recommend(read_book_ids, limit)
 
-    for loan in user_loans:
-        book = loan.book
-        categories[book.category] += 1
-        authors[book.author] += 1
-
-    # Находим любимые категории и авторов
-    favorite_category = categories.most_common(1)[0][0] if categories else None
-    favorite_author = authors.most_common(1)[0][0] if authors else None
-
-    # Формируем рекомендации
-    query = db.query(BookModel)
-
-    # Исключаем уже прочитанные книги
-    read_book_ids = [loan.book_id for loan in user_loans]
-    query = query.filter(~BookModel.id.in_(read_book_ids))
-
-    # Приоритезируем любимые категории и авторов
-    if favorite_category and favorite_author:
-        # Сначала книги того же автора и категории
-        same_author_category = query.filter(
-            BookModel.author == favorite_author,
-            BookModel.category == favorite_category
-        ).limit(limit).all()
-
-        if len(same_author_category) < limit:
-            # Затем книги той же категории
-            same_category = query.filter(
-                BookModel.category == favorite_category
-            ).limit(limit - len(same_author_category)).all()
-
-            if len(same_author_category) + len(same_category) < limit:
-                # Затем книги того же автора
-                same_author = query.filter(
-                    BookModel.author == favorite_author
-                ).limit(limit - len(same_author_category) - len(same_category)).all()
-
-                return same_author_category + same_category + same_author
-            else:
-                return same_author_category + same_category
-        else:
-            return same_author_category
-
-    return get_popular_books(db, limit)
+    # Сохраняем порядок по убыванию близости
+    books = db.query(BookModel).filter(BookModel.id.in_(top_book_ids)).all()
+    books_by_id = {book.id: book for book in books}
+    return [books_by_id[book_id] for book_id in top_book_ids if book_id in books_by_id]
 
 
 def get_popular_books(db: Session, limit: int = 5) -> List[BookModel]:
     """
     Возвращает популярные книги на основе количества займов
     """
-    popular = db.query(BookModel, func.count(LoanModel.id).label('loan_count')) \
-        .outerjoin(LoanModel) \
+    loans = all_loans("id", "book_id")
+    popular = db.query(BookModel, func.count(loans.c.id).label('loan_count')) \
+        .outerjoin(loans, loans.c.book_id == BookModel.id) \
         .group_by(BookModel.id) \
-        .order_by(func.count(LoanModel.id).desc()) \
+        .order_by(func.count(loans.c.id).desc()) \
         .limit(limit) \
         .all()
 
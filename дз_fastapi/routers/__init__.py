@@ -1,2 +1 @@
-from . import users, books, loans
-from .. import recommendations
\ No newline at end of file
+from . import users, books, loans, analytics, metrics
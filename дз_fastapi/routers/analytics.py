@@ -0,0 +1,31 @@
+from fastapi import APIRouter, Depends, HTTPException, Query
+from sqlalchemy.orm import Session
+from typing import List
+
+from database import get_db
+from models import User as UserModel
+from schemas import CategoryMonthLoans, CategoryLoanDuration, OverdueRate
+from auth import get_admin_user
+from loan_stats import loan_columns
+
+router = APIRouter(prefix="/analytics", tags=["analytics"])
+
+
+@router.get("/loans-per-category", response_model=List[CategoryMonthLoans])
+def loans_per_category(db: Session = Depends(get_db),
+                       current_user: UserModel = Depends(get_admin_user)):
+    return loan_columns.get(db).loans_per_category_month()
+
+
+@router.get("/loan-duration", response_model=List[CategoryLoanDuration])
+def loan_duration(db: Session = Depends(get_db),
+                  current_user: UserModel = Depends(get_admin_user)):
+    return loan_columns.get(db).loan_duration_by_category()
+
+
+@router.get("/overdue-rate", response_model=List[OverdueRate])
+def overdue_rate(by: str = "author", limit: int = Query(100, ge=1, le=1000), db: Session = Depends(get_db),
+                 current_user: UserModel = Depends(get_admin_user)):
+    if by not in ("author", "category"):
+        raise HTTPException(status_code=400, detail="Grouping must be 'author' or 'category'")
+    return loan_columns.get(db).overdue_rate(by=by, limit=limit)
@@ -1,26 +1,66 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.orm import Session
 from typing import List, Optional
+import re
 
-from database import get_db
-from models import Book as BookModel, User as UserModel
-from schemas import Book, BookCreate, BookUpdate
+from database import get_db, SessionLocal, IS_POSTGRES
+from models import Book as BookModel, User as UserModel, book_search_vector, SEARCH_CONFIG
+from schemas import Book, BookCreate, BookUpdate, BookSuggestion
 from auth import get_current_user, get_admin_user
+from fast_json import FAST_JSON_RESPONSES, BOOK_COLUMNS, rows_response
+from similarity import similarity_index
+from loan_stats import loan_columns
+from content_index import content_index
+from suggest_index import suggest_index
+from availability import availability_hub, format_event, HEARTBEAT_SECONDS, MAX_BOOKS_PER_SUBSCRIPTION
 
 router = APIRouter(prefix="/books", tags=["books"])
 
 
+def insert_book_statement(book: BookCreate):
+    """
+    INSERT ... ON CONFLICT (isbn) DO NOTHING RETURNING id для PostgreSQL
+    """
+    return pg_insert(BookModel) \
+        .values(**book.dict()) \
+        .on_conflict_do_nothing(index_elements=[BookModel.isbn]) \
+        .returning(BookModel.id)
+
+
+def search_condition(words: List[str]):
+    """
+    Условие полнотекстового поиска: каждое слово запроса - префикс слова названия или автора
+    """
+    ts_query = " & ".join(f"{word}:*" for word in words)
+    return book_search_vector.op("@@")(func.to_tsquery(SEARCH_CONFIG, ts_query))
+
+
 @router.post("/", response_model=Book)
 def create_book(book: BookCreate, db: Session = Depends(get_db),
                 current_user: UserModel = Depends(get_admin_user)):
-    db_book = db.query(BookModel).filter(BookModel.isbn == book.isbn).first()
-    if db_book:
-        raise HTTPException(status_code=400, detail="ISBN already registered")
-
-    db_book = BookModel(**book.dict())
-    db.add(db_book)
-    db.commit()
-    db.refresh(db_book)
+    if IS_POSTGRES:
+        # Одна вставка с ON CONFLICT вместо проверки и вставки, без гонки между воркерами
+        book_id = db.execute(insert_book_statement(book)).scalar()
+        if book_id is None:
+            raise HTTPException(status_code=400, detail="ISBN already registered")
+        db.commit()
+        db_book = db.get(BookModel, book_id)
+    else:
+        db_book = db.query(BookModel).filter(BookModel.isbn == book.isbn).first()
+        if db_book:
+            raise HTTPException(status_code=400, detail="ISBN already registered")
+
+        db_book = BookModel(**book.dict())
+        db.add(db_book)
+        db.commit()
+        db.refresh(db_book)
+    loan_columns.invalidate()
+    content_index.upsert(db_book.id, db_book.title, db_book.author, db_book.category)
+    suggest_index.upsert(db_book.id, db_book.title, db_book.author)
     return db_book
 
 
@@ -32,16 +72,83 @@ def read_books(skip: int = 0, limit: int = 100, category: Optional[str] = None,
     if category:
         query = query.filter(BookModel.category == category)
 
-    if search:
+    words = re.findall(r"\w+", search) if search else []
+    if IS_POSTGRES and words:
+        # Префиксный поиск по словам через GIN-индекс вместо LIKE '%...%'
+        query = query.filter(search_condition(words))
+    elif search:
         query = query.filter(
             (BookModel.title.contains(search)) |
             (BookModel.author.contains(search))
         )
 
+    if FAST_JSON_RESPONSES:
+        rows = query.with_entities(*BOOK_COLUMNS).offset(skip).limit(limit).all()
+        return rows_response(BOOK_COLUMNS, rows)
+
     books = query.offset(skip).limit(limit).all()
     return books
 
 
+@router.get("/suggest", response_model=List[BookSuggestion])
+def suggest_books(q: str, limit: int = Query(10, ge=1, le=50), db: Session = Depends(get_db)):
+    """
+    Подсказки для строки поиска: книги, у которых название или автор начинается с q
+    (или одно из первых слов), самые популярные первыми
+    """
+    suggest_index.ensure_built(db)
+    return [
+        {"id": book_id, "title": title, "author": author}
+        for book_id, title, author in suggest_index.suggest(q, limit)
+    ]
+
+
+def read_availability(book_ids: List[int]) -> dict:
+    """
+    Текущие copies_available в отдельной короткой сессии: соединение возвращается в пул
+    до начала потока, а не после отключения клиента
+    """
+    db = SessionLocal()
+    try:
+        return dict(
+            db.query(BookModel.id, BookModel.copies_available)
+            .filter(BookModel.id.in_(book_ids))
+            .all()
+        )
+    finally:
+        db.close()
+
+
+@router.get("/availability/stream")
+async def stream_availability(book_ids: List[int] = Query(...)):
+    """
+    Server-Sent Events с изменениями copies_available для выбранных книг
+    Первое событие содержит текущие значения, дальше приходят только изменения
+    """
+    if len(set(book_ids)) > MAX_BOOKS_PER_SUBSCRIPTION:
+        raise HTTPException(status_code=400, detail="Too many books in subscription")
+
+    # Подписываемся до чтения текущих значений, чтобы не потерять изменения между ними
+    subscription = availability_hub.subscribe(book_ids)
+    try:
+        current = await run_in_threadpool(read_availability, book_ids)
+    except Exception:
+        availability_hub.unsubscribe(subscription)
+        raise
+
+    async def events():
+        try:
+            yield format_event(current)
+            while True:
+                changes = await subscription.next_batch(HEARTBEAT_SECONDS)
+                yield format_event(changes) if changes else ": keep-alive\n\n"
+        finally:
+            availability_hub.unsubscribe(subscription)
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache"})
+
+
 @router.get("/{book_id}", response_model=Book)
 def read_book(book_id: int, db: Session = Depends(get_db)):
     book = db.query(BookModel).filter(BookModel.id == book_id).first()
@@ -50,6 +157,25 @@ def read_book(book_id: int, db: Session = Depends(get_db)):
     return book
 
 
+@router.get("/{book_id}/similar", response_model=List[Book])
+def read_similar_books(book_id: int, limit: int = Query(10, ge=1, le=50), db: Session = Depends(get_db)):
+    """
+    Книги, которые чаще всего берут вместе с данной
+    """
+    book = db.query(BookModel).filter(BookModel.id == book_id).first()
+    if book is None:
+        raise HTTPException(status_code=404, detail="Book not found")
+
+    similarity_index.ensure_built(db)
+    similar_ids = similarity_index.similar(book_id, limit)
+    if not similar_ids:
+        return []
+
+    books = db.query(BookModel).filter(BookModel.id.in_(similar_ids)).all()
+    books_by_id = {book.id: book for book in books}
+    return [books_by_id[similar_id] for similar_id in similar_ids if similar_id in books_by_id]
+
+
 @router.put("/{book_id}", response_model=Book)
 def update_book(book_id: int, book: BookUpdate, db: Session = Depends(get_db),
                 current_user: UserModel = Depends(get_admin_user)):
@@ -63,6 +189,10 @@ def update_book(book_id: int, book: BookUpdate, db: Session = Depends(get_db),
 
     db.commit()
     db.refresh(db_book)
+    loan_columns.invalidate()
+    content_index.upsert(db_book.id, db_book.title, db_book.author, db_book.category)
+    suggest_index.upsert(db_book.id, db_book.title, db_book.author)
+    availability_hub.publish_current(db, db_book.id)
     return db_book
 
 
@@ -75,4 +205,9 @@ def delete_book(book_id: int, db: Session = Depends(get_db),
 
     db.delete(db_book)
     db.commit()
+    similarity_index.remove_book(book_id)
+    loan_columns.invalidate()
+    content_index.remove(book_id)
+    suggest_index.remove(book_id)
+    availability_hub.publish_current(db, book_id)
     return {"detail": "Book deleted successfully"}
\ No newline at end of file
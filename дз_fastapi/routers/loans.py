@@ -4,9 +4,14 @@ from datetime import datetime, timedelta
 from typing import List
 
 from database import get_db
-from models import Loan as LoanModel, Book as BookModel, User as UserModel
+from models import Loan as LoanModel, LoanHistory as LoanHistoryModel, Book as BookModel, User as UserModel
 from schemas import Loan, LoanCreate
 from auth import get_current_user, get_admin_user
+from fast_json import FAST_JSON_RESPONSES, LOAN_COLUMNS, LOAN_HISTORY_COLUMNS, rows_response
+from similarity import similarity_index
+from loan_stats import loan_columns
+from availability import availability_hub
+from suggest_index import suggest_index
 
 router = APIRouter(prefix="/loans", tags=["loans"])
 
@@ -34,12 +39,20 @@ def create_loan(loan: LoanCreate, db: Session = Depends(get_db),
     db.add(db_loan)
     db.commit()
     db.refresh(db_loan)
+    similarity_index.add_loan(db_loan.user_id, db_loan.book_id)
+    suggest_index.add_loan(db_loan.book_id)
+    loan_columns.add_loan(db_loan)
+    availability_hub.publish_current(db, db_loan.book_id)
     return db_loan
 
 
 @router.get("/", response_model=List[Loan])
 def read_loans(skip: int = 0, limit: int = 100, db: Session = Depends(get_db),
                current_user: UserModel = Depends(get_admin_user)):
+    if FAST_JSON_RESPONSES:
+        rows = db.query(*LOAN_COLUMNS).offset(skip).limit(limit).all()
+        return rows_response(LOAN_COLUMNS, rows)
+
     loans = db.query(LoanModel).offset(skip).limit(limit).all()
     return loans
 
@@ -47,7 +60,14 @@ def read_loans(skip: int = 0, limit: int = 100, db: Session = Depends(get_db),
 @router.get("/my", response_model=List[Loan])
 def read_user_loans(current_user: UserModel = Depends(get_current_user),
                     db: Session = Depends(get_db)):
+    # Текущие займы из горячей таблицы, вернувшиеся давно - из архива
+    if FAST_JSON_RESPONSES:
+        rows = db.query(*LOAN_COLUMNS).filter(LoanModel.user_id == current_user.id).all()
+        rows += db.query(*LOAN_HISTORY_COLUMNS).filter(LoanHistoryModel.user_id == current_user.id).all()
+        return rows_response(LOAN_COLUMNS, rows)
+
     loans = db.query(LoanModel).filter(LoanModel.user_id == current_user.id).all()
+    loans += db.query(LoanHistoryModel).filter(LoanHistoryModel.user_id == current_user.id).all()
     return loans
 
 
@@ -71,6 +91,8 @@ def return_book(loan_id: int, db: Session = Depends(get_db),
 
     db.commit()
     db.refresh(loan)
+    loan_columns.return_loan(loan)
+    availability_hub.publish_current(db, loan.book_id)
     return loan
 
 
@@ -0,0 +1,17 @@
+from fastapi import APIRouter, Depends
+from typing import List
+
+from models import User as UserModel
+from schemas import AdmissionMetrics
+from auth import get_admin_user
+from admission import policies
+
+router = APIRouter(prefix="/metrics", tags=["metrics"])
+
+
+@router.get("/admission", response_model=List[AdmissionMetrics])
+def admission_metrics(current_user: UserModel = Depends(get_admin_user)):
+    """
+    Счётчики допущенных, отклонённых и ожидавших в очереди запросов по каждой политике
+    """
+    return [policy.metrics() for policy in policies]
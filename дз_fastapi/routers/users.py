@@ -6,11 +6,13 @@ from database import get_db
 from models import User as UserModel
 from schemas import User, UserCreate, UserUpdate
 from auth import get_password_hash, get_current_user, get_admin_user
+from fast_json import FAST_JSON_RESPONSES, USER_COLUMNS, rows_response
+from admission import password_admission
 
 router = APIRouter(prefix="/users", tags=["users"])
 
 
-@router.post("/", response_model=User)
+@router.post("/", response_model=User, dependencies=[Depends(password_admission)])
 def create_user(user: UserCreate, db: Session = Depends(get_db)):
     db_user = db.query(UserModel).filter(UserModel.email == user.email).first()
     if db_user:
@@ -35,6 +37,10 @@ def create_user(user: UserCreate, db: Session = Depends(get_db)):
 @router.get("/", response_model=List[User])
 def read_users(skip: int = 0, limit: int = 100, db: Session = Depends(get_db),
                current_user: UserModel = Depends(get_admin_user)):
+    if FAST_JSON_RESPONSES:
+        rows = db.query(*USER_COLUMNS).offset(skip).limit(limit).all()
+        return rows_response(USER_COLUMNS, rows)
+
     users = db.query(UserModel).offset(skip).limit(limit).all()
     return users
 
@@ -60,6 +60,12 @@ class Book(BookBase):
         from_attributes = True
 
 
+class BookSuggestion(BaseModel):
+    id: int
+    title: str
+    author: str
+
+
 # Loan schemas
 class LoanBase(BaseModel):
     user_id: int
@@ -99,4 +105,36 @@ class RecommendationRequest(BaseModel):
 
 class RecommendationResponse(BaseModel):
     books: List[Book]
-    reason: str
\ No newline at end of file
+    reason: str
+
+
+# Analytics schemas
+class CategoryMonthLoans(BaseModel):
+    category: str
+    month: str
+    loans: int
+
+
+class CategoryLoanDuration(BaseModel):
+    category: str
+    returned_loans: int
+    average_days: float
+
+
+class OverdueRate(BaseModel):
+    name: str
+    loans: int
+    overdue: int
+    overdue_rate: float
+
+
+class AdmissionMetrics(BaseModel):
+    name: str
+    admitted: int
+    rejected_rate: int
+    rejected_queue_full: int
+    rejected_queue_timeout: int
+    queued: int
+    queue_wait_seconds: float
+    active: int
+    waiting: int
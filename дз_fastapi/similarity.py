@@ -0,0 +1,398 @@
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+from collections import defaultdict
+from itertools import islice
+import logging
+import threading
+
+import numpy as np
+from scipy import sparse
+from sqlalchemy.orm import Session
+
+from database import STREAM_BATCH_SIZE
+from archive import all_loans
+
+logger = logging.getLogger(__name__)
+
+# Новые совместные займы копятся в словаре и вливаются в разреженную матрицу пачками в фоне
+DELTA_LIMIT = 100_000
+
+
+class CoOccurrenceIndex:
+    """
+    Индекс "книги, которые берут вместе"
+    Число читателей для каждой пары книг хранится в разреженной матрице, для каждой книги
+    заранее посчитан топ-k соседей, поэтому запрос похожих книг сводится к чтению строки массива
+    """
+
+    def __init__(self, top_k: int = 20):
+        self.top_k = top_k
+        self.built = False
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self._generation = 0
+        self._update_thread: Optional[threading.Thread] = None
+        self._merge_thread: Optional[threading.Thread] = None
+        empty = sparse.csr_matrix((0, 0), dtype=np.int32)
+        self._reset(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), empty, empty,
+                    np.zeros(0), np.zeros((0, top_k), dtype=np.int32), np.zeros(0))
+
+    def build(self, db: Session) -> None:
+        loans = all_loans("user_id", "book_id")
+        pairs = db.query(loans.c.user_id, loans.c.book_id) \
+            .filter(loans.c.user_id.isnot(None), loans.c.book_id.isnot(None)) \
+            .distinct() \
+            .yield_per(STREAM_BATCH_SIZE)
+        self.build_from_pairs(pairs)
+
+    def build_from_pairs(self, pairs: Iterable[Tuple[int, int]]) -> None:
+        # Пары читаются пачками прямо в массив, без списка кортежей всех займов
+        chunks = []
+        iterator = iter(pairs)
+        while True:
+            batch = list(islice(iterator, STREAM_BATCH_SIZE))
+            if not batch:
+                break
+            chunks.append(np.array(batch, dtype=np.int64).reshape(-1, 2))
+        pairs = np.concatenate(chunks) if chunks else np.zeros((0, 2), dtype=np.int64)
+        user_ids, user_idx = np.unique(pairs[:, 0], return_inverse=True)
+        book_ids, book_idx = np.unique(pairs[:, 1], return_inverse=True)
+
+        # Матрица "пользователь x книга", повторные займы одной книги схлопываются в 1
+        user_books = sparse.csr_matrix(
+            (np.ones(len(pairs), dtype=np.int32), (user_idx, book_idx)),
+            shape=(len(user_ids), len(book_ids))
+        )
+        user_books.data[:] = 1
+
+        # Совместные займы всех пар книг одним разреженным произведением
+        co = (user_books.T @ user_books).tocsr()
+        co.setdiag(0)
+        co.eliminate_zeros()
+        co.sort_indices()
+        popularity = np.diff(user_books.tocsc().indptr).astype(np.float64)
+
+        # Топы считаются до захвата блокировки, под ней только подмена массивов
+        alive = np.ones(len(book_ids), dtype=bool)
+        neighbours = np.full((len(book_ids), self.top_k), -1, dtype=np.int32)
+        floor = np.full(len(book_ids), -1.0)
+        for book in range(len(book_ids)):
+            start, end = co.indptr[book], co.indptr[book + 1]
+            if end > start:
+                neighbours[book], floor[book] = self._top(
+                    book, co.indices[start:end], co.data[start:end], book_ids, popularity, alive
+                )
+
+        with self._lock:
+            self._generation += 1
+            self._reset(book_ids, user_ids, user_books, co, popularity, neighbours, floor)
+            self.built = True
+
+    def ensure_built(self, db: Session) -> None:
+        if not self.built:
+            # Параллельные запросы ждут одну сборку, а не строят индекс каждый сам
+            with self._build_lock:
+                if not self.built:
+                    self.build(db)
+
+    def add_loan(self, user_id: int, book_id: int) -> None:
+        """
+        Инкрементально учитывает новый займ без полной перестройки индекса
+        Мера пар новой книги с уже прочитанными растёт, поэтому сравнивается с порогом их топа сразу;
+        у остальных соседей мера с ней только уменьшилась, их топ пересчитывается в фоне
+        """
+        with self._lock:
+            if not self.built:
+                return
+            book = self._index(book_id, create=True)
+            borrowed = self._books_of(user_id)
+            if not self._alive[book] or book in borrowed:
+                return
+
+            self._user_extra.setdefault(user_id, set()).add(book)
+            self._popularity[book] += 1
+            borrowed = borrowed[self._alive[borrowed]]
+            for other in borrowed.tolist():
+                row = self._pending[other]
+                row[book] = row.get(book, 0) + 1
+                row = self._pending[book]
+                row[other] = row.get(other, 0) + 1
+            self._pending_size += len(borrowed) + 1
+
+            if len(borrowed):
+                scores = self._counts(book, borrowed) \
+                    / np.sqrt(self._popularity[book] * self._popularity[borrowed])
+                listed = (self._neighbours[borrowed] == book).any(axis=1)
+                for other in borrowed[listed | (scores >= self._floor[borrowed])].tolist():
+                    self._offer(other, np.array([book]))
+                # Порядок остальных соседей книги не меняется: их мера делится на один и тот же множитель
+                self._offer(book, borrowed)
+
+            self._changed.add(book)
+            start_update, start_merge = self._schedule()
+        self._start(start_update, start_merge)
+
+    def remove_book(self, book_id: int) -> None:
+        with self._lock:
+            if not self.built:
+                return
+            book = self._index(book_id)
+            if book is None or not self._alive[book]:
+                return
+            self._alive[book] = False
+            self._neighbours[book] = -1
+            # Удалённая книга сразу не видна в выдаче, топы, где она была, доберут соседей в фоне
+            self._changed.add(book)
+            start_update, start_merge = self._schedule()
+        self._start(start_update, start_merge)
+
+    def similar(self, book_id: int, limit: int = 10) -> List[int]:
+        with self._lock:
+            book = self._index(book_id)
+            if book is None or not self._alive[book]:
+                return []
+            row = self._neighbours[book]
+            row = row[row >= 0]
+            row = row[self._alive[row]][:limit]
+            return self._book_ids[row].tolist()
+
+    def wait_for_updates(self) -> None:
+        while True:
+            threads = [thread for thread in (self._update_thread, self._merge_thread)
+                       if thread is not None and thread.is_alive()]
+            if not threads:
+                return
+            for thread in threads:
+                thread.join()
+
+    def _reset(self, book_ids: np.ndarray, user_ids: np.ndarray, user_books: sparse.csr_matrix,
+               co: sparse.csr_matrix, popularity: np.ndarray, neighbours: np.ndarray,
+               floor: np.ndarray) -> None:
+        # Книги базовой матрицы отсортированы по id, новые дописываются в конец и ищутся по словарю
+        self._base_ids = book_ids
+        self._new_index: Dict[int, int] = {}
+        self._user_ids = user_ids
+        self._user_books = user_books
+        self._co = co
+        self._size = len(book_ids)
+        self._book_ids = book_ids.copy()
+        self._popularity = popularity
+        self._alive = np.ones(len(book_ids), dtype=bool)
+        self._neighbours = neighbours
+        self._floor = floor
+        # Совместные займы и займы пользователей после сборки; _merging - то, что сейчас вливается в фоне
+        self._pending: Dict[int, Dict[int, int]] = defaultdict(dict)
+        self._merging: Dict[int, Dict[int, int]] = {}
+        self._user_extra: Dict[int, Set[int]] = {}
+        self._merging_users: Dict[int, Set[int]] = {}
+        self._pending_size = 0
+        # Книги, у которых выросла популярность или которые удалены: топы с ними пересчитываются в фоне
+        self._changed: Set[int] = set()
+        self._updating = False
+
+    def _grow(self, capacity: int) -> None:
+        if capacity <= len(self._book_ids):
+            return
+        # Массивы растут удвоением, как list
+        capacity = max(capacity, 1024, 2 * len(self._book_ids))
+        size = self._size
+        book_ids, popularity = np.zeros(capacity, dtype=np.int64), np.zeros(capacity)
+        alive, floor = np.zeros(capacity, dtype=bool), np.full(capacity, -1.0)
+        neighbours = np.full((capacity, self.top_k), -1, dtype=np.int32)
+        book_ids[:size], popularity[:size], alive[:size] = \
+            self._book_ids[:size], self._popularity[:size], self._alive[:size]
+        floor[:size], neighbours[:size] = self._floor[:size], self._neighbours[:size]
+        self._book_ids, self._popularity, self._alive = book_ids, popularity, alive
+        self._floor, self._neighbours = floor, neighbours
+
+    def _index(self, book_id: int, create: bool = False) -> Optional[int]:
+        position = int(np.searchsorted(self._base_ids, book_id))
+        if position < len(self._base_ids) and self._base_ids[position] == book_id:
+            return position
+        book = self._new_index.get(book_id)
+        if book is None and create:
+            self._grow(self._size + 1)
+            book = self._new_index[book_id] = self._size
+            self._book_ids[book] = book_id
+            self._alive[book] = True
+            self._size += 1
+        return book
+
+    def _books_of(self, user_id: int) -> np.ndarray:
+        parts = []
+        position = int(np.searchsorted(self._user_ids, user_id))
+        if position < len(self._user_ids) and self._user_ids[position] == user_id:
+            start, end = self._user_books.indptr[position], self._user_books.indptr[position + 1]
+            parts.append(self._user_books.indices[start:end])
+        for users in (self._merging_users, self._user_extra):
+            books = users.get(user_id)
+            if books:
+                parts.append(np.fromiter(books, dtype=np.int32, count=len(books)))
+        if not parts:
+            return np.zeros(0, dtype=np.int32)
+        return np.unique(np.concatenate(parts)) if len(parts) > 1 else parts[0]
+
+    def _row(self, book: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Все книги, которые брали вместе с данной, и число общих читателей
+        """
+        columns, counts = [], []
+        if book < self._co.shape[0]:
+            start, end = self._co.indptr[book], self._co.indptr[book + 1]
+            columns.append(self._co.indices[start:end])
+            counts.append(self._co.data[start:end])
+        for delta in (self._merging, self._pending):
+            row = delta.get(book)
+            if row:
+                columns.append(np.fromiter(row.keys(), dtype=np.int32, count=len(row)))
+                counts.append(np.fromiter(row.values(), dtype=np.int32, count=len(row)))
+        if not columns:
+            return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32)
+        if len(columns) == 1:
+            return columns[0], counts[0]
+        columns, inverse = np.unique(np.concatenate(columns), return_inverse=True)
+        return columns, np.bincount(inverse, weights=np.concatenate(counts)).astype(np.int32)
+
+    def _counts(self, book: int, others: np.ndarray) -> np.ndarray:
+        counts = np.zeros(len(others))
+        if book < self._co.shape[0] and len(others):
+            start, end = self._co.indptr[book], self._co.indptr[book + 1]
+            columns = self._co.indices[start:end]
+            positions = np.minimum(np.searchsorted(columns, others), max(len(columns) - 1, 0))
+            if len(columns):
+                found = columns[positions] == others
+                counts[found] = self._co.data[start:end][positions[found]]
+        for delta in (self._merging, self._pending):
+            row = delta.get(book)
+            if row:
+                counts += [row.get(other, 0) for other in others.tolist()]
+        return counts
+
+    def _offer(self, book: int, candidates: np.ndarray) -> None:
+        """
+        Пересчитывает топ книги по текущим соседям и кандидатам, мера остальных пар не менялась
+        """
+        current = self._neighbours[book]
+        columns = np.union1d(current[current >= 0], candidates)
+        self._rank(book, columns, self._counts(book, columns))
+
+    def _rank(self, book: int, columns: np.ndarray, counts: np.ndarray) -> None:
+        self._neighbours[book], self._floor[book] = self._top(
+            book, columns, counts, self._book_ids, self._popularity, self._alive
+        )
+
+    def _top(self, book: int, columns: np.ndarray, counts: np.ndarray, book_ids: np.ndarray,
+             popularity: np.ndarray, alive: np.ndarray) -> Tuple[np.ndarray, float]:
+        """
+        Топ-k соседей книги и мера последнего из них (порог), если топ заполнен
+        """
+        # Косинусная мера: совместные займы / sqrt(популярность обеих книг)
+        keep = alive[columns] & (columns != book) & (counts > 0)
+        columns, counts = columns[keep], counts[keep]
+        scores = counts / np.sqrt(popularity[book] * popularity[columns])
+        top = min(self.top_k, len(columns))
+        row = np.full(self.top_k, -1, dtype=np.int32)
+        if not top:
+            return row, -1.0
+        # Все книги с мерой, равной k-й, идут в сортировку,
+        # иначе при равенстве мер выбор зависел бы от порядка столбцов
+        best = np.flatnonzero(scores >= -np.partition(-scores, top - 1)[top - 1])
+        best = best[np.lexsort((book_ids[columns[best]], -scores[best]))][:top]
+        row[:top] = columns[best]
+        # Ниже этой меры новая пара в топ не попадёт
+        return row, scores[best[-1]] if top == self.top_k else -1.0
+
+    def _schedule(self) -> Tuple[bool, bool]:
+        """
+        Отмечает, какие фоновые потоки нужно запустить; вызывается под self._lock
+        """
+        start_update = bool(self._changed) and not self._updating
+        if start_update:
+            self._updating = True
+            self._update_thread = threading.Thread(target=self._update, args=(self._generation,),
+                                                   daemon=True)
+        start_merge = self._pending_size >= DELTA_LIMIT and not self._merging and not self._merging_users
+        if start_merge:
+            self._merging, self._pending = self._pending, defaultdict(dict)
+            self._merging_users, self._user_extra = self._user_extra, {}
+            self._pending_size = 0
+            self._merge_thread = threading.Thread(target=self._merge, daemon=True)
+        return start_update, start_merge
+
+    def _start(self, start_update: bool, start_merge: bool) -> None:
+        if start_update:
+            self._update_thread.start()
+        if start_merge:
+            self._merge_thread.start()
+
+    def _update(self, generation: int) -> None:
+        """
+        Пересчитывает топы, в которых стоят книги из self._changed
+        Блокировка берётся на каждую книгу отдельно, запросы между ними не ждут
+        """
+        while True:
+            with self._lock:
+                if generation != self._generation or not self._changed:
+                    if generation == self._generation:
+                        self._updating = False
+                    return
+                book = self._changed.pop()
+                columns, _ = self._row(book)
+                listing = columns[(self._neighbours[columns] == book).any(axis=1)].tolist()
+            for other in listing:
+                with self._lock:
+                    if generation != self._generation:
+                        return
+                    if self._alive[other]:
+                        self._rank(other, *self._row(other))
+
+    def _merge(self) -> None:
+        """
+        Вливает накопленные совместные займы и займы пользователей в разреженные матрицы
+        Тяжёлая часть идёт без блокировки, под ней только подмена
+        """
+        with self._lock:
+            generation = self._generation
+            co, user_books, user_ids = self._co, self._user_books, self._user_ids
+            merging, merging_users, size = self._merging, self._merging_users, self._size
+        try:
+            co, user_books, user_ids = self._merged(co, user_books, user_ids, merging,
+                                                    merging_users, size)
+        except Exception:
+            logger.exception("Similarity index merge failed")
+            return
+
+        with self._lock:
+            if generation != self._generation:
+                return  # индекс перестроили, пока шло слияние
+            self._co, self._user_books, self._user_ids = co, user_books, user_ids
+            self._merging, self._merging_users = {}, {}
+            start_update, start_merge = self._schedule()
+        self._start(start_update, start_merge)
+
+    @staticmethod
+    def _merged(co: sparse.csr_matrix, user_books: sparse.csr_matrix, user_ids: np.ndarray,
+                merging: Dict[int, Dict[int, int]], merging_users: Dict[int, Set[int]],
+                size: int) -> Tuple[sparse.csr_matrix, sparse.csr_matrix, np.ndarray]:
+        rows = np.repeat(np.array(list(merging), dtype=np.int32), [len(row) for row in merging.values()])
+        columns = np.fromiter((other for row in merging.values() for other in row), dtype=np.int32)
+        counts = np.fromiter((count for row in merging.values() for count in row.values()), dtype=np.int32)
+        co = sparse.csr_matrix((co.data, co.indices, np.pad(co.indptr, (0, size - co.shape[0]), "edge")),
+                               shape=(size, size))
+        co = (co + sparse.csr_matrix((counts, (rows, columns)), shape=(size, size))).tocsr()
+        co.sort_indices()
+
+        # Строки пользователей пересобираются целиком: новые пользователи встают на своё место по id
+        users = [np.repeat(user_ids, np.diff(user_books.indptr))]
+        books = [user_books.indices]
+        for user_id, extra in merging_users.items():
+            users.append(np.full(len(extra), user_id, dtype=np.int64))
+            books.append(np.fromiter(extra, dtype=np.int32, count=len(extra)))
+        user_ids, user_idx = np.unique(np.concatenate(users), return_inverse=True)
+        books = np.concatenate(books)
+        user_books = sparse.csr_matrix((np.ones(len(books), dtype=np.int32), (user_idx, books)),
+                                       shape=(len(user_ids), size))
+        user_books.data[:] = 1
+        return co, user_books, user_ids
+
+
+similarity_index = CoOccurrenceIndex()
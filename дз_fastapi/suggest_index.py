@@ -0,0 +1,361 @@
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+import bisect
+import re
+import threading
+import unicodedata
+
+import numpy as np
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from database import STREAM_BATCH_SIZE
+from models import Book as BookModel
+from archive import all_loans
+
+# Ключи хранятся в массиве байтов фиксированной ширины: память на книгу ограничена сверху
+MAX_KEY_BYTES = 24
+# С начала скольких слов названия и автора ищется префикс
+MAX_WORDS = 4
+# Диапазоны не длиннее этого ранжируются честно, для более длинных берутся заранее посчитанные кандидаты
+SCAN_LIMIT = 2048
+HEAVY_CANDIDATES = 50
+# Новые ключи копятся в отсортированном списке и вливаются в основной массив пачками
+DELTA_LIMIT = 1024
+
+Suggestion = Tuple[int, str, str]
+
+WORD_PATTERN = re.compile(r"\w+")
+
+
+def normalize(text: Optional[str]) -> str:
+    """
+    Нижний регистр, без диакритики и знаков препинания: "Ёжик, в тумане" -> "ежик в тумане"
+    """
+    text = (text or "").casefold()
+    if not text.isascii():
+        text = unicodedata.normalize("NFKD", text)
+        text = "".join(char for char in text if not unicodedata.combining(char))
+    return " ".join(WORD_PATTERN.findall(text))
+
+
+def prefix_keys(text: Optional[str]) -> List[bytes]:
+    words = normalize(text).split(" ")
+    return [
+        " ".join(words[start:]).encode()[:MAX_KEY_BYTES]
+        for start in range(min(len(words), MAX_WORDS))
+        if words[start]
+    ]
+
+
+def book_keys(title: Optional[str], author: Optional[str]) -> Set[bytes]:
+    return set(prefix_keys(title) + prefix_keys(author))
+
+
+class SuggestIndex:
+    """
+    Префиксный индекс для подсказок по названиям и авторам
+    Отсортированный массив ключей с бинарным поиском, ранжирование по числу займов
+    """
+
+    def __init__(self):
+        self.built = False
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self._merge_thread: Optional[threading.Thread] = None
+        self._generation = 0
+        # Записи во время сборки: применяются к собранному индексу перед подменой
+        self._building = False
+        self._replay: List[Tuple[Callable[..., bool], tuple]] = []
+        self._reset()
+
+    def build(self, db: Session) -> None:
+        loans = all_loans("book_id")
+        popularity = dict(
+            db.query(loans.c.book_id, func.count()).group_by(loans.c.book_id).all()
+        )
+        rows = db.query(BookModel.id, BookModel.title, BookModel.author) \
+            .yield_per(STREAM_BATCH_SIZE)
+        self.build_from_rows(
+            (book_id, title, author, popularity.get(book_id, 0)) for book_id, title, author in rows
+        )
+
+    def build_from_rows(self, rows: Iterable[Tuple[int, str, str, int]]) -> None:
+        # Чтение из БД и сортировка идут без блокировки, под ней только подмена
+        with self._lock:
+            self._building = True
+        try:
+            book_ids, titles, authors, popularity, keys, key_slots = [], [], [], [], [], []
+            slot_of: Dict[int, int] = {}
+            for book_id, title, author, book_popularity in rows:
+                slot = slot_of[book_id] = len(book_ids)
+                book_ids.append(book_id)
+                titles.append(title)
+                authors.append(author)
+                popularity.append(book_popularity)
+                for key in book_keys(title, author):
+                    keys.append(key)
+                    key_slots.append(slot)
+
+            popularity = np.array(popularity, dtype=np.float64)
+            keys = np.array(keys, dtype=f"S{MAX_KEY_BYTES}")
+            order = np.argsort(keys, kind="stable")
+            keys = keys[order]
+            key_slots = np.array(key_slots, dtype=np.int32)[order]
+            heavy = self._heavy_prefixes(keys, key_slots, popularity)
+        except BaseException:
+            with self._lock:
+                self._building = False
+                self._replay = []
+            raise
+
+        with self._lock:
+            self._reset()
+            self._keys, self._key_slots, self._heavy = keys, key_slots, heavy
+            self._book_ids, self._titles, self._authors = book_ids, titles, authors
+            self._slot_of, self._popularity = slot_of, popularity
+            self._alive = np.ones(len(book_ids), dtype=bool)
+            self.built = True
+            # Займ во время сборки мог попасть и в выборку из БД: лишняя единица популярности не страшна
+            start_merge = False
+            for write, args in self._replay:
+                start_merge = write(*args) or start_merge
+            self._replay = []
+            self._building = False
+        if start_merge:
+            self._merge_thread.start()
+
+    def ensure_built(self, db: Session) -> None:
+        if not self.built:
+            # Параллельные запросы ждут одну сборку, а не строят индекс каждый сам
+            with self._build_lock:
+                if not self.built:
+                    self.build(db)
+
+    def upsert(self, book_id: int, title: str, author: str) -> None:
+        with self._lock:
+            start_merge = self._record(self._upsert, book_id, title, author)
+        if start_merge:
+            self._merge_thread.start()
+
+    def remove(self, book_id: int) -> None:
+        with self._lock:
+            self._record(self._remove, book_id)
+
+    def add_loan(self, book_id: int) -> None:
+        with self._lock:
+            self._record(self._add_loan, book_id)
+
+    def _record(self, write: Callable[..., bool], *args) -> bool:
+        """
+        Применяет запись к индексу, а во время сборки ещё и запоминает её; вызывается под self._lock
+        Возвращает True, если нужно запустить фоновое слияние
+        """
+        if self._building:
+            self._replay.append((write, args))
+        if not self.built:
+            return False
+        return write(*args)
+
+    def _upsert(self, book_id: int, title: str, author: str) -> bool:
+        popularity = 0
+        old_slot = self._slot_of.get(book_id)
+        if old_slot is not None:
+            if (self._titles[old_slot], self._authors[old_slot]) == (title, author):
+                return False
+            self._alive[old_slot] = False
+            popularity = self._popularity[old_slot]
+        for entry in self._add(book_id, title, author, popularity):
+            bisect.insort(self._pending, entry)
+        start_merge = len(self._pending) >= DELTA_LIMIT and not self._merging
+        if start_merge:
+            # Слияние с основным массивом идёт в фоне, запись не ждёт его
+            self._merging, self._pending = self._pending, []
+            self._merge_thread = threading.Thread(target=self._merge, daemon=True)
+        return start_merge
+
+    def _remove(self, book_id: int) -> bool:
+        slot = self._slot_of.pop(book_id, None)
+        if slot is not None:
+            self._alive[slot] = False
+        return False
+
+    def _add_loan(self, book_id: int) -> bool:
+        slot = self._slot_of.get(book_id)
+        if slot is None:
+            return False
+        self._popularity[slot] += 1
+        self._promote(slot)
+        if self._merging:
+            self._loaned_during_merge.add(slot)
+        return False
+
+    def suggest(self, query: str, limit: int = 10) -> List[Suggestion]:
+        prefix = normalize(query).encode()[:MAX_KEY_BYTES - 1]
+        if not prefix:
+            return []
+        upper = prefix + b"\xff"  # 0xff не встречается в UTF-8, поэтому это верхняя граница префикса
+
+        with self._lock:
+            lo = int(np.searchsorted(self._keys, prefix, side="left"))
+            hi = int(np.searchsorted(self._keys, upper, side="left"))
+            if hi - lo > SCAN_LIMIT:
+                candidates = self._heavy.get(prefix, self._key_slots[lo:lo + SCAN_LIMIT])
+            else:
+                candidates = self._key_slots[lo:hi]
+
+            for pending in (self._pending, self._merging):
+                start = bisect.bisect_left(pending, (prefix,))
+                end = bisect.bisect_left(pending, (upper,))
+                if end > start:
+                    slots = np.array([slot for _, slot in pending[start:end]], dtype=np.int32)
+                    candidates = np.concatenate([candidates, slots])
+
+            candidates = np.unique(candidates)
+            candidates = candidates[self._alive[candidates]]
+            scores = self._popularity[candidates]
+            if len(candidates) > limit:
+                best = np.argpartition(-scores, limit - 1)[:limit]
+                candidates, scores = candidates[best], scores[best]
+            order = candidates[np.lexsort((candidates, -scores))]
+            return [(self._book_ids[slot], self._titles[slot], self._authors[slot]) for slot in order]
+
+    def _reset(self) -> None:
+        self._keys = np.array([], dtype=f"S{MAX_KEY_BYTES}")
+        self._key_slots = np.array([], dtype=np.int32)
+        self._pending: List[Tuple[bytes, int]] = []
+        # Ключи, которые сейчас вливаются в основной массив фоновым слиянием
+        self._merging: List[Tuple[bytes, int]] = []
+        self._loaned_during_merge = set()
+        self._generation += 1
+        self._heavy: Dict[bytes, np.ndarray] = {}
+        self._heavy_floor: Dict[bytes, float] = {}
+        self._book_ids: List[int] = []
+        self._titles: List[str] = []
+        self._authors: List[str] = []
+        self._slot_of: Dict[int, int] = {}
+        self._popularity = np.zeros(0)
+        self._alive = np.zeros(0, dtype=bool)
+
+    def _add(self, book_id: int, title: str, author: str,
+             popularity: float) -> List[Tuple[bytes, int]]:
+        """
+        Заводит слот книги и возвращает её ключи
+        """
+        slot = len(self._book_ids)
+        if slot == len(self._popularity):
+            # Массивы растут удвоением, как list
+            capacity = max(1024, 2 * slot)
+            popularity_array, alive = np.zeros(capacity), np.zeros(capacity, dtype=bool)
+            popularity_array[:slot], alive[:slot] = self._popularity, self._alive
+            self._popularity, self._alive = popularity_array, alive
+        self._popularity[slot] = popularity
+        self._alive[slot] = True
+        self._book_ids.append(book_id)
+        self._titles.append(title)
+        self._authors.append(author)
+        self._slot_of[book_id] = slot
+        return [(key, slot) for key in book_keys(title, author)]
+
+    def wait_for_merge(self) -> None:
+        if self._merge_thread is not None:
+            self._merge_thread.join()
+
+    def _merge(self) -> None:
+        """
+        Вливает отложенные ключи в основной массив, выкидывает ключи удалённых книг
+        и пересчитывает кандидатов для длинных диапазонов
+        Тяжёлая часть идёт без блокировки, под ней только подмена массивов
+        """
+        with self._lock:
+            generation = self._generation
+            keys, key_slots, merging = self._keys, self._key_slots, self._merging
+
+        live = self._alive[key_slots]
+        keys, key_slots = keys[live], key_slots[live]
+        new_keys = np.array([key for key, _ in merging], dtype=f"S{MAX_KEY_BYTES}")
+        new_slots = np.array([slot for _, slot in merging], dtype=np.int32)
+        positions = np.searchsorted(keys, new_keys)
+        keys = np.insert(keys, positions, new_keys)
+        key_slots = np.insert(key_slots, positions, new_slots)
+        heavy = self._heavy_prefixes(keys, key_slots, self._popularity)
+
+        with self._lock:
+            if generation != self._generation:
+                return  # индекс перестроили, пока шло слияние
+            self._keys, self._key_slots, self._heavy = keys, key_slots, heavy
+            self._heavy_floor = {}
+            self._merging = []
+            # Займы во время слияния могли не попасть в пересчитанных кандидатов
+            for slot in self._loaned_during_merge:
+                self._promote(slot)
+            self._loaned_during_merge = set()
+
+    def _promote(self, slot: int) -> None:
+        """
+        Добавляет книгу в кандидаты длинных префиксов её ключей, если она популярнее худшего из них;
+        вызывается под self._lock
+        """
+        if not self._heavy:
+            return
+        score = self._popularity[slot]
+        for key in book_keys(self._titles[slot], self._authors[slot]):
+            for depth in range(1, len(key) + 1):
+                prefix = key[:depth]
+                candidates = self._heavy.get(prefix)
+                if candidates is None:
+                    break  # диапазон префикса короче диапазона родителя, дальше длинных нет
+                # Порог - нижняя оценка худшего кандидата, чтобы не трогать массив на каждый займ
+                floor = self._heavy_floor.get(prefix)
+                if floor is None:
+                    floor = self._heavy_floor[prefix] = self._floor(candidates)
+                if score <= floor or slot in candidates:
+                    continue
+                if len(candidates) < HEAVY_CANDIDATES * MAX_WORDS:
+                    candidates = np.append(candidates, slot)
+                else:
+                    # Удалённые книги вытесняются первыми
+                    scores = np.where(self._alive[candidates], self._popularity[candidates], -1)
+                    worst = int(np.argmin(scores))
+                    if score <= scores[worst]:
+                        continue
+                    candidates = candidates.copy()
+                    candidates[worst] = slot
+                self._heavy[prefix] = candidates
+                self._heavy_floor[prefix] = self._floor(candidates)
+
+    def _floor(self, candidates: np.ndarray) -> float:
+        if len(candidates) < HEAVY_CANDIDATES * MAX_WORDS:
+            return -1
+        return float(np.where(self._alive[candidates], self._popularity[candidates], -1).min())
+
+    def _heavy_prefixes(self, keys: np.ndarray, key_slots: np.ndarray,
+                        popularity: np.ndarray) -> Dict[bytes, np.ndarray]:
+        """
+        Для каждого префикса с диапазоном длиннее SCAN_LIMIT запоминает самые популярные книги
+        Таких префиксов на каждой глубине не больше len(keys) / SCAN_LIMIT
+        """
+        heavy = {}
+        key_bytes = keys.view(np.uint8).reshape(-1, MAX_KEY_BYTES)
+        stack = [(b"", 0, len(keys))]
+        while stack:
+            prefix, lo, hi = stack.pop()
+            if prefix:
+                slots = key_slots[lo:hi]
+                scores = popularity[slots]
+                top = min(len(slots), HEAVY_CANDIDATES * MAX_WORDS)
+                best = slots[np.argpartition(-scores, top - 1)[:top]]
+                heavy[prefix] = np.unique(best)
+            depth = len(prefix)
+            if depth == MAX_KEY_BYTES:
+                continue
+
+            # Диапазон уже отсортирован, поэтому дети префикса - отрезки с одинаковым следующим байтом
+            column = key_bytes[lo:hi, depth]
+            bounds = np.concatenate([[0], np.flatnonzero(np.diff(column)) + 1, [hi - lo]])
+            for start, end in zip(bounds[:-1], bounds[1:]):
+                if end - start > SCAN_LIMIT and column[start] != 0:
+                    stack.append((prefix + bytes([column[start]]), lo + start, lo + end))
+        return heavy
+
+
+suggest_index = SuggestIndex()
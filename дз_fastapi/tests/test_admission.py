@@ -0,0 +1,55 @@
+import asyncio
+
+from fastapi import Depends, FastAPI
+from fastapi.testclient import TestClient
+
+from admission import AdmissionPolicy, ConcurrencyLimiter, password_admission
+from main import app as library_app
+from routers import users
+
+
+def test_rate_limit_per_client_and_route():
+    policy = AdmissionPolicy("test", rate=0.01, burst=2)
+    app = FastAPI(dependencies=[Depends(policy)])
+    app.get("/a")(lambda: "a")
+    app.get("/b")(lambda: "b")
+    client = TestClient(app)
+
+    assert [client.get("/a").status_code for _ in range(3)] == [200, 200, 429]
+    assert int(client.get("/a").headers["Retry-After"]) > 0
+    # У другого маршрута своя корзина
+    assert client.get("/b").status_code == 200
+    assert policy.metrics()["rejected_rate"] == 2
+
+
+def test_concurrency_limiter_queue():
+    async def scenario():
+        limiter = ConcurrencyLimiter(limit=1, queue_size=1, timeout=0.05)
+        assert limiter.try_acquire()
+        assert not limiter.try_acquire()
+
+        waiter = asyncio.create_task(limiter.wait())
+        await asyncio.sleep(0)
+        assert limiter.waiting == 1 and not limiter.can_queue()
+
+        # Слот передаётся ожидающему, а не освобождается
+        limiter.release()
+        assert await waiter and limiter.active == 1
+
+        # Без освобождения ожидание заканчивается по таймауту
+        assert not await limiter.wait()
+        assert limiter.waiting == 0
+
+        limiter.release()
+        assert limiter.active == 0
+
+    asyncio.run(scenario())
+
+
+def test_password_routes_are_limited():
+    # Все маршруты с bcrypt делят одну политику и её лимит одновременных запросов
+    routes = [(library_app, "/token"), (library_app, "/register"), (users.router, "/users/")]
+    for app, path in routes:
+        route = next(route for route in app.routes
+                     if getattr(route, "path", None) == path and "POST" in route.methods)
+        assert any(dependency.call is password_admission for dependency in route.dependant.dependencies)
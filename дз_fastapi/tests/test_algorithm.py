@@ -0,0 +1,246 @@
+from datetime import datetime
+import threading
+import time
+
+import numpy as np
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from database import Base
+from models import Book, Loan
+import similarity
+from similarity import CoOccurrenceIndex
+from loan_stats import LoanColumns
+from content_index import ContentIndex
+import content_index as content_index_module
+import recommendations
+
+
+LOAN_PAIRS = [
+    (1, 10), (1, 20), (1, 30),
+    (2, 10), (2, 20),
+    (3, 20), (3, 40),
+]
+
+
+def test_similar_books_ranked_by_co_occurrence():
+    index = CoOccurrenceIndex(top_k=5)
+    index.build_from_pairs(LOAN_PAIRS)
+
+    assert index.similar(10) == [20, 30]
+    assert index.similar(40) == [20]
+    assert index.similar(10, limit=1) == [20]
+    assert index.similar(999) == []
+
+
+def test_incremental_update_matches_full_rebuild():
+    incremental = CoOccurrenceIndex(top_k=5)
+    incremental.build_from_pairs(LOAN_PAIRS)
+    incremental.add_loan(3, 30)
+    incremental.add_loan(3, 30)  # повторный займ не меняет индекс
+    incremental.wait_for_updates()
+
+    rebuilt = CoOccurrenceIndex(top_k=5)
+    rebuilt.build_from_pairs(LOAN_PAIRS + [(3, 30)])
+
+    for book_id in (10, 20, 30, 40):
+        assert incremental.similar(book_id) == rebuilt.similar(book_id)
+
+
+def test_incremental_updates_with_delta_merges_match_full_rebuild(monkeypatch):
+    monkeypatch.setattr(similarity, "DELTA_LIMIT", 50)
+    rng = np.random.default_rng(0)
+    pairs = list(dict.fromkeys(
+        (int(user), int(book)) for user, book in zip(rng.integers(0, 60, 1500), rng.zipf(1.5, 1500) % 80)
+    ))
+    removed = 7
+    incremental = CoOccurrenceIndex(top_k=5)
+    incremental.build_from_pairs(pairs[:500])
+    for user, book in pairs[500:1000]:
+        incremental.add_loan(user, book)
+    incremental.remove_book(removed)
+    for user, book in pairs[1000:]:
+        if book != removed:
+            incremental.add_loan(user, book)
+    incremental.wait_for_updates()
+
+    rebuilt = CoOccurrenceIndex(top_k=5)
+    rebuilt.build_from_pairs([(user, book) for user, book in pairs if book != removed])
+    for book_id in range(80):
+        assert incremental.similar(book_id) == rebuilt.similar(book_id)
+
+
+def test_removed_book_disappears_from_neighbours():
+    index = CoOccurrenceIndex(top_k=5)
+    index.build_from_pairs(LOAN_PAIRS)
+    index.remove_book(20)
+    index.wait_for_updates()
+
+    assert index.similar(20) == []
+    assert index.similar(10) == [30]
+    assert index.similar(40) == []
+
+
+def test_empty_index():
+    index = CoOccurrenceIndex()
+    index.build_from_pairs([])
+    assert index.built
+    assert index.similar(1) == []
+
+
+def make_loan_columns():
+    def dates(*values):
+        return np.array(values, dtype="datetime64[s]")
+
+    return LoanColumns(
+        authors=np.array(["Austen", "Tolstoy"], dtype=object),
+        categories=np.array(["Classic", "Novel"], dtype=object),
+        loan_author=np.array([0, 0, 1, 1]),
+        loan_category=np.array([0, 0, 0, 1]),
+        loan_date=dates("2024-01-01", "2024-01-20", "2024-02-01", "2024-02-10"),
+        due_date=dates("2024-01-15", "2024-02-03", "2024-02-15", "2024-02-24"),
+        return_date=dates("2024-01-11", "2024-02-05", None, None),
+    )
+
+
+def test_loan_aggregates():
+    columns = make_loan_columns()
+    assert columns.loans_per_category_month() == [
+        {"category": "Classic", "month": "2024-01", "loans": 2},
+        {"category": "Classic", "month": "2024-02", "loans": 1},
+        {"category": "Novel", "month": "2024-02", "loans": 1},
+    ]
+    assert columns.loan_duration_by_category() == [
+        {"category": "Classic", "returned_loans": 2, "average_days": 13.0},
+    ]
+    assert columns.overdue_rate(by="author", now=datetime(2024, 2, 20)) == [
+        {"name": "Austen", "loans": 2, "overdue": 1, "overdue_rate": 0.5},
+        {"name": "Tolstoy", "loans": 2, "overdue": 1, "overdue_rate": 0.5},
+    ]
+
+
+CATALOG = [
+    (1, "War and Peace", "Leo Tolstoy", "Novel"),
+    (2, "Anna Karenina", "Leo Tolstoy", "Novel"),
+    (3, "Peace Talks", "Jim Butcher", "Fantasy"),
+    (4, "Python Cookbook", "David Beazley", "Programming"),
+]
+
+
+def test_content_index_ranks_by_profile_similarity():
+    index = ContentIndex()
+    index.build_from_rows(CATALOG)
+
+    # Общий автор и категория весят больше, чем одно общее слово названия
+    assert index.recommend([1]) == [2, 3]
+    assert index.recommend([1], limit=1) == [2]
+    assert index.recommend([999]) == []
+
+
+def test_content_index_updates_on_book_writes():
+    index = ContentIndex()
+    index.build_from_rows(CATALOG)
+
+    index.upsert(5, "Fluent Python", "Luciano Ramalho", "Programming")
+    assert index.recommend([4]) == [5]
+
+    index.upsert(5, "Fluent Python", "Luciano Ramalho", "Novel")
+    index.remove(2)
+    assert index.recommend([1]) == [5, 3]
+
+
+def test_content_delta_merges_in_background(monkeypatch):
+    reference = ContentIndex()
+    reference.build_from_rows(CATALOG)
+    index = ContentIndex()
+    index.build_from_rows(CATALOG)
+
+    started, release = threading.Event(), threading.Event()
+    layout = ContentIndex._layout
+
+    def blocked_layout(matrix, book_ids):
+        started.set()
+        release.wait()
+        return layout(matrix, book_ids)
+
+    monkeypatch.setattr(content_index_module, "DELTA_LIMIT", 3)
+    monkeypatch.setattr(ContentIndex, "_layout", staticmethod(blocked_layout))
+    writes = [
+        (5, "Fluent Python", "Luciano Ramalho", "Programming"),
+        (6, "Peace and War", "Leo Tolstoy", "Novel"),
+        (7, "Resurrection", "Leo Tolstoy", "Novel"),
+    ]
+    for book_id, title, author, category in writes:
+        index.upsert(book_id, title, author, category)
+        reference.upsert(book_id, title, author, category)
+    assert started.wait(5)
+
+    # Пока слияние идёт, записи и рекомендации его не ждут, а записи не теряются при подмене
+    for target in (index, reference):
+        target.upsert(5, "Fluent Python", "Luciano Ramalho", "Novel")
+        target.remove(2)
+        target.upsert(8, "Python Tricks", "Dan Bader", "Programming")
+    assert index.recommend([4]) == reference.recommend([4])
+    release.set()
+    index.wait_for_merge()
+
+    assert index._base.shape[0] == 7 and index._delta.shape[0] == 2 and not index._base_alive[1]
+    for history in ([1], [4], [5], [1, 8]):
+        assert index.recommend(history) == reference.recommend(history)
+
+
+def test_content_recommendations_skip_read_books(monkeypatch):
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(bind=engine)
+    db = sessionmaker(bind=engine)()
+    db.add_all([Book(id=book_id, title=title, author=author, isbn=str(book_id), published_year=2000,
+                     category=category) for book_id, title, author, category in CATALOG if book_id != 3])
+    db.add_all([Loan(user_id=2, book_id=book_id, due_date=datetime(2024, 1, 15)) for book_id in (1, 2)])
+    db.commit()
+    monkeypatch.setattr(recommendations, "content_index", ContentIndex())
+
+    # Всё похожее уже прочитано: популярные книги 1 и 2 не подставляются вместо пустого ответа
+    assert recommendations.content_based_filtering(db, user_id=2) == []
+    db.close()
+
+
+def test_content_index_builds_once_and_rebuilds_in_background(tmp_path, monkeypatch):
+    engine = create_engine(f"sqlite:///{tmp_path}/books.db")
+    Base.metadata.create_all(bind=engine)
+    session_factory = sessionmaker(bind=engine)
+    with session_factory() as db:
+        db.add_all([Book(id=book_id, title=title, author=author, isbn=str(book_id), published_year=2000,
+                         category=category) for book_id, title, author, category in CATALOG])
+        db.commit()
+
+    builds = []
+    build_matrix = ContentIndex._build_matrix
+
+    def slow_build_matrix(self, rows):
+        builds.append(1)
+        time.sleep(0.05)
+        return build_matrix(self, rows)
+
+    monkeypatch.setattr(ContentIndex, "_build_matrix", slow_build_matrix)
+    index = ContentIndex(session_factory=session_factory)
+
+    def ensure_built():
+        with session_factory() as db:
+            index.ensure_built(db)
+
+    threads = [threading.Thread(target=ensure_built) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(builds) == 1
+
+    # Устаревший индекс отвечает, пока новый строится; запись во время сборки не теряется
+    index.stale = True
+    with index._build_lock:
+        ensure_built()
+        assert index.recommend([1]) == [2, 3]
+        index.upsert(5, "Anna Karenina Notes", "Leo Tolstoy", "Novel")
+    index.wait_for_rebuild()
+    assert len(builds) == 2 and not index.stale
+    assert index.recommend([2], limit=2) == [5, 1]
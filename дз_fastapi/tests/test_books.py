@@ -1,5 +1,17 @@
+import asyncio
+import threading
+
 import pytest
+from fastapi import FastAPI
 from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session, sessionmaker
+
+from availability import AvailabilityHub
+from database import Base
+from models import Book as BookModel
+from routers import books as books_router
+from suggest_index import SuggestIndex
 
 
 def test_create_book_admin_required():
@@ -48,3 +60,157 @@ def test_search_books():
     response = client.get("/books/?search=fiction")
     assert response.status_code == 200
     assert isinstance(response.json(), list)
+
+
+def test_availability_updates_are_coalesced():
+    async def scenario():
+        hub = AvailabilityHub()
+        subscription = hub.subscribe([1, 2])
+        hub.publish(1, 3)
+        hub.publish(1, 2)
+        hub.publish(3, 5)  # на книгу 3 никто не подписан
+        await asyncio.sleep(0)
+        changes = await subscription.next_batch(timeout=1)
+
+        hub.unsubscribe(subscription)
+        hub.publish(2, 0)
+        await asyncio.sleep(0)
+        return changes, await subscription.next_batch(timeout=0.01)
+
+    changes, after_unsubscribe = asyncio.run(scenario())
+    assert changes == {1: 2}
+    assert after_unsubscribe == {}
+
+
+def test_suggest_prefixes_ranked_by_popularity():
+    index = SuggestIndex()
+    index.build_from_rows([
+        (1, "War and Peace", "Leo Tolstoy", 5),
+        (2, "Anna Karenina", "Leo Tolstoy", 9),
+        (3, "Peace Talks", "Jim Butcher", 1),
+        (4, "Ёжик в тумане", "Сергей Козлов", 0),
+    ])
+
+    assert [book_id for book_id, _, _ in index.suggest("pea")] == [1, 3]
+    assert [book_id for book_id, _, _ in index.suggest("LEO", limit=1)] == [2]
+    assert [book_id for book_id, _, _ in index.suggest("еж")] == [4]
+    assert index.suggest("  ") == []
+
+    index.upsert(5, "Peaceful Warrior", "Dan Millman")
+    for _ in range(6):
+        index.add_loan(5)
+    index.remove(1)
+    assert [book_id for book_id, _, _ in index.suggest("peace")] == [5, 3]
+
+
+def test_suggest_promotes_books_under_long_prefixes():
+    index = SuggestIndex()
+    index.build_from_rows([(book_id, f"Common title {book_id}", "Author", 0) for book_id in range(3000)])
+    for _ in range(100):
+        index.add_loan(0)
+    assert index.suggest("common", 3)[0][0] == 0
+
+    # Фоновое слияние пересчитывает кандидатов и учитывает займы, пришедшие во время него
+    for book_id in range(3000, 3000 + 1024):
+        index.upsert(book_id, f"Common addition {book_id}", "Author")
+    for _ in range(200):
+        index.add_loan(1)
+    index.wait_for_merge()
+    assert [book_id for book_id, _, _ in index.suggest("common", 2)] == [1, 0]
+
+
+def test_availability_stream_releases_session(tmp_path, monkeypatch):
+    class TrackedSession(Session):
+        open_sessions = 0
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            TrackedSession.open_sessions += 1
+
+        def close(self):
+            TrackedSession.open_sessions -= 1
+            super().close()
+
+    engine = create_engine(f"sqlite:///{tmp_path}/books.db")
+    Base.metadata.create_all(bind=engine)
+    session_factory = sessionmaker(bind=engine, class_=TrackedSession)
+    with session_factory() as db:
+        db.add(BookModel(id=1, title="Emma", author="Austen", isbn="1", published_year=1815,
+                         category="Classic", copies_available=3))
+        db.commit()
+    monkeypatch.setattr(books_router, "SessionLocal", session_factory)
+
+    async def first_event():
+        response = await books_router.stream_availability(book_ids=[1])
+        try:
+            return await response.body_iterator.__anext__(), TrackedSession.open_sessions
+        finally:
+            await response.body_iterator.aclose()
+
+    # Поток ещё открыт, а сессия уже закрыта
+    event, open_sessions = asyncio.run(first_event())
+    assert event == 'event: availability\ndata: [{"book_id": 1, "copies_available": 3}]\n\n'
+    assert open_sessions == 0
+
+
+def test_similar_books_limit_is_validated():
+    app = FastAPI()
+    app.include_router(books_router.router)
+    client = TestClient(app)
+    for limit in (0, -1, 51):
+        assert client.get(f"/books/1/similar?limit={limit}").status_code == 422
+
+
+def test_suggest_build_does_not_block_writes():
+    index = SuggestIndex()
+
+    def rows():
+        yield 1, "War and Peace", "Leo Tolstoy", 5
+        # Сборка ещё идёт: записи не ждут её и не теряются при подмене
+        writer = threading.Thread(target=lambda: [index.upsert(2, "Peace Talks", "Jim Butcher"),
+                                                  index.add_loan(2), index.remove(3)])
+        writer.start()
+        writer.join(timeout=5)
+        assert not writer.is_alive()
+        yield 3, "Peaceful Warrior", "Dan Millman", 9
+
+    index.build_from_rows(rows())
+    for _ in range(5):
+        index.add_loan(2)
+    assert [book_id for book_id, _, _ in index.suggest("peace")] == [2, 1]
+
+
+def test_availability_publishes_latest_committed_value(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path}/books.db")
+    Base.metadata.create_all(bind=engine)
+    session_factory = sessionmaker(bind=engine)
+    with session_factory() as db:
+        db.add(BookModel(id=1, title="Emma", author="Austen", isbn="1", published_year=1815,
+                         copies_available=3, total_copies=3))
+        db.commit()
+
+    async def scenario():
+        hub = AvailabilityHub()
+        subscription = hub.subscribe([1])
+        first, second = session_factory(), session_factory()
+        first.get(BookModel, 1).copies_available -= 1
+        first.commit()
+        second.get(BookModel, 1).copies_available -= 1
+        second.commit()
+
+        # Займы публикуют в обратном порядке коммитов, но оба читают текущее значение
+        hub.publish_current(second, 1)
+        hub.publish_current(first, 1)
+        await asyncio.sleep(0)
+        latest = await subscription.next_batch(timeout=1)
+
+        second.delete(second.get(BookModel, 1))
+        second.commit()
+        hub.publish_current(second, 1)
+        await asyncio.sleep(0)
+        deleted = await subscription.next_batch(timeout=1)
+        first.close()
+        second.close()
+        return latest, deleted
+
+    assert asyncio.run(scenario()) == ({1: 1}, {1: 0})
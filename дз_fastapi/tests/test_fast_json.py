@@ -0,0 +1,51 @@
+from datetime import datetime
+from typing import List
+
+import pytest
+from pydantic import TypeAdapter
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from database import Base
+from models import Book as BookModel, Loan as LoanModel, User as UserModel
+from schemas import Book, Loan, User
+from fast_json import BOOK_COLUMNS, LOAN_COLUMNS, USER_COLUMNS, dump_rows
+
+
+@pytest.fixture
+def db():
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(bind=engine)
+    session = sessionmaker(bind=engine)()
+    session.add_all([
+        UserModel(id=1, email="reader@example.com", username="reader", hashed_password="x"),
+        UserModel(id=2, email="admin@example.com", username="admin", hashed_password="x", is_admin=True),
+        BookModel(id=1, title="War and Peace", author="Leo Tolstoy", isbn="1", published_year=1869,
+                  category="Novel", copies_available=0, total_copies=2),
+        BookModel(id=2, title="Ёжик в тумане", author="Сергей Козлов", isbn="2", published_year=1975,
+                  category="Сказка"),
+        LoanModel(id=1, user_id=1, book_id=1, loan_date=datetime(2024, 1, 1, 10, 30),
+                  due_date=datetime(2024, 1, 15, 10, 30, 0, 123456), status="active"),
+        LoanModel(id=2, user_id=2, book_id=2, loan_date=datetime(2024, 2, 1),
+                  due_date=datetime(2024, 2, 15), return_date=datetime(2024, 2, 10, 8, 5, 1),
+                  status="returned"),
+    ])
+    session.commit()
+    yield session
+    session.close()
+
+
+@pytest.mark.parametrize("model, schema, columns", [
+    (BookModel, Book, BOOK_COLUMNS),
+    (LoanModel, Loan, LOAN_COLUMNS),
+    (UserModel, User, USER_COLUMNS),
+])
+def test_fast_path_matches_response_model(db, model, schema, columns):
+    # Так ответ сериализует FastAPI при response_model=List[schema]
+    adapter = TypeAdapter(List[schema])
+    expected = adapter.dump_json(adapter.validate_python(db.query(model).order_by(model.id).all(),
+                                                         from_attributes=True))
+
+    fast = dump_rows(columns, db.query(*columns).order_by(model.id).all())
+
+    assert fast == expected
@@ -0,0 +1,141 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from auth import get_admin_user
+from database import Base
+from models import Book, Loan, LoanHistory
+from archive import archive_returned_loans, all_loans
+from loan_stats import LoanColumns, LoanColumnsCache
+from routers import analytics as analytics_router
+
+
+@pytest.fixture
+def db():
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(bind=engine)
+    session = sessionmaker(bind=engine)()
+    yield session
+    session.close()
+
+
+def test_archive_moves_only_old_returned_loans(db):
+    now = datetime.utcnow()
+    db.add_all([
+        Loan(id=1, user_id=1, book_id=1, due_date=now, status="active"),
+        Loan(id=2, user_id=1, book_id=2, due_date=now, status="returned",
+             return_date=now - timedelta(days=400)),
+        Loan(id=3, user_id=1, book_id=3, due_date=now, status="returned",
+             return_date=now - timedelta(days=1)),
+        Loan(id=4, user_id=2, book_id=1, due_date=now, status="returned",
+             return_date=now - timedelta(days=200)),
+    ])
+    db.commit()
+
+    assert archive_returned_loans(db, older_than=timedelta(days=90), batch_size=1) == 2
+    assert sorted(loan.id for loan in db.query(Loan)) == [1, 3]
+    assert sorted(loan.id for loan in db.query(LoanHistory)) == [2, 4]
+
+    # Чтение через all_loans видит и горячую таблицу, и архив
+    loans = all_loans("user_id", "book_id")
+    assert sorted(book_id for (book_id,) in
+                  db.query(loans.c.book_id).filter(loans.c.user_id == 1)) == [1, 2, 3]
+
+    assert archive_returned_loans(db, older_than=timedelta(days=90)) == 0
+
+
+def test_new_loan_ids_do_not_reuse_archived_ids(db):
+    now = datetime.utcnow()
+    db.add_all([
+        Loan(id=1, user_id=1, book_id=1, due_date=now, status="active"),
+        Loan(id=2, user_id=1, book_id=2, due_date=now, status="returned",
+             return_date=now - timedelta(days=400)),
+    ])
+    db.commit()
+    assert archive_returned_loans(db, older_than=timedelta(days=90)) == 1
+
+    loan = Loan(user_id=1, book_id=3, due_date=now, status="active")
+    db.add(loan)
+    db.commit()
+    assert loan.id == 3
+
+
+def test_loan_snapshot_applies_writes_without_reload(tmp_path, monkeypatch):
+    engine = create_engine(f"sqlite:///{tmp_path}/loans.db")
+    Base.metadata.create_all(bind=engine)
+    session_factory = sessionmaker(bind=engine)
+    db = session_factory()
+    db.add_all([
+        Book(id=1, title="Emma", author="Austen", isbn="1", published_year=1815, category="Classic"),
+        Book(id=2, title="War and Peace", author="Tolstoy", isbn="2", published_year=1869, category="Novel"),
+        Loan(id=1, user_id=1, book_id=1, loan_date=datetime(2024, 1, 1), due_date=datetime(2024, 1, 15),
+             return_date=datetime(2024, 1, 11, 0, 0, 0, 500000), status="returned"),
+    ])
+    db.commit()
+
+    loads = []
+    from_db = LoanColumns.from_db
+    monkeypatch.setattr(LoanColumns, "from_db", classmethod(lambda cls, session: loads.append(1) or from_db(session)))
+    cache = LoanColumnsCache(session_factory)
+    assert cache.get(db).loan_duration_by_category() == [
+        {"category": "Classic", "returned_loans": 1, "average_days": 10.0},
+    ]
+
+    loan = Loan(id=2, user_id=1, book_id=2, loan_date=datetime(2024, 2, 1), due_date=datetime(2024, 2, 15),
+                status="active")
+    db.add(loan)
+    db.commit()
+    cache.add_loan(loan)
+    loan.return_date, loan.status = datetime(2024, 2, 5), "returned"
+    db.commit()
+    cache.return_loan(loan)
+
+    assert cache.get(db).loan_duration_by_category() == [
+        {"category": "Classic", "returned_loans": 1, "average_days": 10.0},
+        {"category": "Novel", "returned_loans": 1, "average_days": 4.0},
+    ]
+    assert len(loads) == 1
+
+    # Изменение книги перестраивает снимок в фоне, до подмены отвечает старый
+    db.get(Book, 2).category = "Epic"
+    db.commit()
+    cache.invalidate()
+    with cache._build_lock:  # фоновое перестроение ждёт, пока отвечает старый снимок
+        assert "Novel" in cache.get(db).categories
+    cache.wait_for_rebuild()
+    assert list(cache.get(db).categories) == ["Classic", "Epic"]
+    assert len(loads) == 2
+    db.close()
+
+
+def test_loan_columns_find_loans_committed_out_of_order():
+    dates = np.array(["2024-01-01"] * 2, dtype="datetime64[s]")
+    columns = LoanColumns(
+        authors=np.array(["Austen"], dtype=object), categories=np.array(["Classic"], dtype=object),
+        loan_author=np.zeros(2, dtype=np.int64), loan_category=np.zeros(2, dtype=np.int64),
+        loan_date=dates, due_date=dates, return_date=np.array(["NaT"] * 2, dtype="datetime64[s]"),
+        loan_ids=np.array([1, 5], dtype=np.int64), book_ids=np.array([1], dtype=np.int64),
+        book_author=np.zeros(1, dtype=np.int64), book_category=np.zeros(1, dtype=np.int64),
+    )
+    # Займ 7 закоммичен раньше займа 6
+    for loan_id in (7, 6, 8):
+        assert columns.add_loan(loan_id, 1, datetime(2024, 1, 2), datetime(2024, 1, 16))
+
+    assert all(columns.has_loan(loan_id) for loan_id in (1, 5, 6, 7, 8))
+    assert not any(columns.has_loan(loan_id) for loan_id in (2, 9))
+    assert columns.return_loan(6, datetime(2024, 1, 3))
+    assert list(np.flatnonzero(~np.isnat(columns.return_date[:columns.size]))) == [3]
+
+
+def test_overdue_rate_limit_is_validated():
+    app = FastAPI()
+    app.include_router(analytics_router.router)
+    app.dependency_overrides[get_admin_user] = lambda: None
+    client = TestClient(app)
+    for limit in (0, -1, 1001):
+        assert client.get(f"/analytics/overdue-rate?limit={limit}").status_code == 422